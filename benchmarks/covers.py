@@ -0,0 +1,73 @@
+"""Compare full and reduced-resolution decoding of large JPEG covers
+
+Usage: python benchmarks/covers.py [cover.jpg ...]
+
+Without arguments a sample of large covers is generated in a temporary
+directory.
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from PIL import Image, ImageOps
+
+from lib2opds.sidecars import open_cover_image
+
+
+def generate_covers(dirpath: Path, count: int) -> list[Path]:
+    result: list[Path] = []
+    for i in range(count):
+        fpath = dirpath / f"cover-{i}.jpg"
+        im = Image.linear_gradient("L").resize((3000, 4500)).convert("RGB")
+        im = Image.blend(im, Image.effect_noise((3000, 4500), 64).convert("RGB"), 0.5)
+        im.save(fpath, "JPEG", quality=90)
+        result.append(fpath)
+    return result
+
+
+def decode_full(fpath: Path, size: tuple[int, int]) -> tuple[int, int]:
+    im = Image.open(fpath)
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+    im.load()
+    decoded = im.size
+    ImageOps.contain(im, size)
+    return decoded
+
+
+def decode_draft(fpath: Path, size: tuple[int, int]) -> tuple[int, int]:
+    im = open_cover_image(fpath, size)
+    im.load()
+    decoded = im.size
+    ImageOps.contain(im, size)
+    return decoded
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("covers", nargs="*", type=Path)
+    parser.add_argument("--count", type=int, default=20)
+    parser.add_argument("--width", type=int, default=500)
+    parser.add_argument("--height", type=int, default=500)
+    args = parser.parse_args()
+    size = (args.width, args.height)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        covers = args.covers or generate_covers(Path(tmpdir), args.count)
+        for name, decode in (("full", decode_full), ("draft", decode_draft)):
+            started = time.perf_counter()
+            pixels = 0
+            for fpath in covers:
+                (width, height) = decode(fpath, size)
+                pixels = max(pixels, width * height)
+            elapsed = time.perf_counter() - started
+            print(
+                f"{name:>5}: {elapsed / len(covers) * 1000:.1f} ms per cover,"
+                f" largest decoded image {pixels * 3 / 2**20:.1f} MiB"
+            )
+
+
+if __name__ == "__main__":
+    main()
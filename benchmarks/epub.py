@@ -0,0 +1,40 @@
+"""Show how much of each EPUB file is read to get its metadata and cover
+
+Usage: python benchmarks/epub.py book.epub [book.epub ...]
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+from lib2opds.formats.epub import EpubFile
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("books", nargs="+", type=Path)
+    parser.add_argument("--width", type=int, default=500)
+    parser.add_argument("--height", type=int, default=500)
+    args = parser.parse_args()
+
+    total_size = 0
+    total_read = 0
+    started = time.perf_counter()
+    for fpath in args.books:
+        book = EpubFile(fpath, (args.width, args.height))
+        result = book.read()
+        size = fpath.stat().st_size
+        total_size += size
+        total_read += book.bytes_read
+        print(f"{book.bytes_read:>12} / {size:>12} bytes {result!s:>5} {fpath}")
+    elapsed = time.perf_counter() - started
+
+    if total_size:
+        print(
+            f"read {total_read} of {total_size} bytes"
+            f" ({total_read / total_size:.1%}) in {elapsed:.2f} s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Compare sequential and parallel export of a generated catalog
+
+Usage: python benchmarks/export.py [--books N] [--jobs N]
+
+Every book is listed in its letter feed, its author feed and the feed of
+all books, like in a real catalog.
+"""
+
+import argparse
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from lib2opds.config import Config
+from lib2opds.exporters import export_feeds
+from lib2opds.feeds import AcquisitionFeed, NavigationFeed
+from lib2opds.publications import AcquisitionLink, Publication
+
+
+def generate_catalog(config: Config, count: int) -> NavigationFeed:
+    root = NavigationFeed(config, None, None, "Library", key="root")
+    letters = NavigationFeed(config, root, root, "By title", key="letters")
+    authors = NavigationFeed(config, root, root, "By author", key="authors")
+    feed_all = AcquisitionFeed(config, root, root, "All books", key="all")
+    root.entries.extend([letters, authors, feed_all])
+    feeds: dict[str, AcquisitionFeed] = {}
+
+    updated = datetime(2024, 1, 1)
+    for i in range(count):
+        title = f"{chr(ord('A') + i % 26)} book {i}"
+        author = f"Author {i % (count // 10 + 1)}"
+        p = Publication(
+            title,
+            authors=[author],
+            description="Description of the book. " * 20,
+            _id=f"book-{i}",
+            acquisition_links=[
+                AcquisitionLink(f"/library/{i}.epub", "application/epub+zip")
+            ],
+            updated=updated,
+        )
+        for parent, key in ((letters, title[0]), (authors, author)):
+            if (feed := feeds.get(key)) is None:
+                feed = AcquisitionFeed(config, root, parent, key, key=key)
+                feeds[key] = feed
+                parent.entries.append(feed)
+            feed.publications.append(p)
+        feed_all.publications.append(p)
+    root.sort()
+    return root
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--books", type=int, default=20000)
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--page-size", type=int, default=500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for jobs in (1, args.jobs):
+            config = Config(
+                opds_dir=Path(tmpdir) / str(jobs),
+                page_size=args.page_size,
+                export_jobs=jobs,
+            )
+            catalog = generate_catalog(config, args.books)
+            started = time.perf_counter()
+            export_feeds(config, catalog, ["xml", "html"])
+            elapsed = time.perf_counter() - started
+            print(f"{jobs:>2} jobs: {elapsed:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
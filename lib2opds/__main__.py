@@ -1,5 +1,6 @@
 import argparse
 import os
+import sys
 from dataclasses import dataclass, field
 from datetime import datetime
 from pathlib import Path
@@ -8,22 +9,29 @@ from jinja2 import Environment, PackageLoader, select_autoescape
 
 from lib2opds import __version__
 from lib2opds.config import Config
+from lib2opds.deltas import apply_delta, write_delta
+from lib2opds.exporters import export_feeds
+from lib2opds.feeds import get_entry_version
+from lib2opds.fragments import FRAGMENT_CACHE_FILENAME, FragmentCache
+from lib2opds.manifests import DirectoryManifest, FeedManifest
 from lib2opds.opds import lib2odps
+from lib2opds.outputs import OutputWriter
+from lib2opds.publishers import StagedPublisher, replace_file
 
 CONFIG_PATH = "/etc/lib2opds.ini"
 env = Environment(loader=PackageLoader("lib2opds"), autoescape=select_autoescape())
 
 
-def export_assets(config: Config) -> bool:
+def export_assets(config: Config, output: OutputWriter | None = None) -> bool:
     assets: list[str] = ["navigation-feed.xsl", "acquisition-feed.xsl", "style.css"]
     for asset in assets:
         template = env.get_template(asset)
         data = template.render(config=config)
         local_path = config.get_assets_dir() / asset
-        local_path.parent.mkdir(parents=True, exist_ok=True)
-
-        with local_path.open(mode="w") as f:
-            f.write(data)
+        if output:
+            output.write(local_path, data)
+        else:
+            replace_file(local_path, data)
 
     return True
 
@@ -79,6 +87,11 @@ def cli() -> None:
         help="clear cache directory before generating result feeds",
         action="store_true",
     )
+    parser.add_argument(
+        "--retry-failed",
+        help="read again ebook files which couldn't be read by previous runs",
+        action="store_true",
+    )
     parser.add_argument("--version", action="version", version=__version__)
     parser.add_argument(
         "--generate-site",
@@ -90,29 +103,132 @@ def cli() -> None:
         help="generate HTML output with help of XSLT client-side processing of OPDS catalog",
         action="store_true",
     )
+    parser.add_argument(
+        "--changed-paths-file",
+        help="file to write paths of changed and removed catalog files to",
+    )
+    parser.add_argument(
+        "--delta-dir", help="directory to write deltas of the OPDS directory to"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="number of processes for extracting metadata from ebook files",
+        type=int,
+    )
+    parser.add_argument(
+        "--export-jobs",
+        help="number of processes for rendering feeds, default is 1",
+        type=int,
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    apply_delta_parser = subparsers.add_parser(
+        "apply-delta", help="apply a delta of the OPDS directory to its mirror"
+    )
+    apply_delta_parser.add_argument("delta", help="delta JSON file")
+    apply_delta_parser.add_argument("target", help="mirror of the OPDS directory")
+    apply_delta_parser.add_argument(
+        "--source", help="directory with changed files if the delta has no tar file"
+    )
+    apply_delta_parser.add_argument(
+        "--force",
+        help="apply the delta even if the mirror differs from its base",
+        action="store_true",
+    )
     args = parser.parse_args()
 
+    if args.command == "apply-delta":
+        source_dir = Path(args.source) if args.source else None
+        if not apply_delta(Path(args.delta), Path(args.target), source_dir, args.force):
+            sys.exit(1)
+        return
+
     config = Config()
-    config.load_from_file(Path(CONFIG_PATH))
-    config.load_from_file(Path(args.config))
+    try:
+        config.load_from_file(Path(CONFIG_PATH))
+        config.load_from_file(Path(args.config))
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
     config.load_from_args(args)
     opds_updated = None
-    library_updated = get_utime_dir(config.library_dir)
 
     if config.opds_dir.is_dir():
         opds_updated = datetime.fromtimestamp(config.opds_dir.stat().st_mtime)
 
-    if args.update or not opds_updated or opds_updated < library_updated:
+    directories: DirectoryManifest | None = None
+    directories_loaded = False
+    if manifest_path := config.get_manifest_path("directories.json"):
+        directories = DirectoryManifest(manifest_path, config)
+        directories_loaded = directories.load()
+
+    if args.update or not opds_updated:
+        library_updated = True
+    elif directories and directories_loaded:
+        library_updated = directories.is_library_changed()
+    else:
+        library_updated = opds_updated < get_utime_dir(config.library_dir)
+
+    if library_updated:
         if config.invalidate_cache and config.cache_dir is not None:
             clear_dir(config.cache_dir)
-        if config.clear_opds_dir:
+
+        # A staged build is written next to the published catalog and
+        # replaces it at once at the end
+        publisher: StagedPublisher | None = None
+        if config.publish_mode == "staged":
+            publisher = StagedPublisher(config.opds_dir)
+            if not publisher.stage(seed=not config.clear_opds_dir):
+                return
+            config.staging_dir = publisher.staging_dir
+        elif config.clear_opds_dir:
             clear_dir(config.opds_dir)
-        opds_catalog = lib2odps(config, config.library_dir)
-        opds_catalog.export_as_xml()
+
+        # Files with the same content as in the last run are not written,
+        # and deltas are made against the last run also after clearing
+        output = OutputWriter(
+            config.get_output_dir(), config.get_manifest_path("outputs.json")
+        )
+        output.load(skip_unchanged=not config.clear_opds_dir)
+
+        opds_catalog = lib2odps(config, config.library_dir, directories, output)
+
+        feed_manifest: FeedManifest | None = None
+        if manifest_path := config.get_manifest_path("feeds.json"):
+            feed_manifest = FeedManifest(manifest_path, config)
+            feed_manifest.load()
+            feed_manifest.update(opds_catalog)
+
+        # Entries rendered in earlier runs are reused for unchanged books
+        fragments = FragmentCache(
+            config.get_manifest_path(FRAGMENT_CACHE_FILENAME), get_entry_version()
+        )
+        kinds = ["xml", "html"] if config.generate_site else ["xml"]
+        export_feeds(config, opds_catalog, kinds, output, fragments)
         if config.generate_site or config.generate_site_xslt:
-            export_assets(config)
-        if config.generate_site:
-            opds_catalog.export_as_html()
+            export_assets(config, output)
+        fragments.close(opds_catalog.get_all_publications())
+
+        if feed_manifest:
+            for local_path in feed_manifest.remove_stale_feeds():
+                output.remove(local_path)
+
+        if publisher:
+            if not publisher.publish():
+                return
+            publisher.cleanup()
+
+        output.save()
+        if config.delta_dir:
+            write_delta(output, config.delta_dir, config.delta_tar)
+        if config.changed_paths_file:
+            output.write_changed_paths(config.changed_paths_file)
+        if feed_manifest:
+            feed_manifest.save()
+
+        # Saved last, so an interrupted run is repeated next time
+        if directories:
+            directories.save()
 
 
 if __name__ == "__main__":
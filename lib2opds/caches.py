@@ -0,0 +1,695 @@
+import configparser
+import fcntl
+import filecmp
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any
+
+from lib2opds.config import Config
+from lib2opds.publishers import replace_file
+from lib2opds.scanner import FileStat, get_file_stat
+from lib2opds.sidecars import (
+    CoverSidecarFile,
+    InfoSidecarFile,
+    MetadataSidecarFile,
+    get_cover_sidecar_file,
+    get_metadata_sidecar_file,
+)
+
+SQLITE_CACHE_FILENAME = "cache.sqlite"
+SQLITE_CACHE_VERSION = 4
+SQLITE_CACHE_TABLES = ("metadata", "covers", "failures")
+SQLITE_CACHE_BATCH_SIZE = 256
+CONTENT_FINGERPRINT_CHUNK_SIZE = 64 * 1024
+FICLONE = 0x40049409
+
+
+def copy_file(src: Path, dst: Path, mode: str = "copy") -> bool:
+    """Copy src to a new dst file, sharing data blocks with src if mode allows
+
+    dst is kept if it has the same content already. Otherwise it is removed
+    first, so a hardlinked copy is never written in place.
+    """
+    try:
+        if dst.is_file() and (
+            os.path.samefile(src, dst) or filecmp.cmp(src, dst, shallow=False)
+        ):
+            return True
+        dst.unlink(missing_ok=True)
+        if mode == "hardlink":
+            try:
+                os.link(src, dst)
+                return True
+            except OSError:
+                pass
+        elif mode == "reflink":
+            try:
+                with src.open("rb") as fsrc, dst.open("wb") as fdst:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return True
+            except OSError:
+                pass
+        shutil.copyfile(src, dst)
+    except OSError:
+        return False
+    return True
+
+
+def get_file_fingerprint(fpath: Path, stat: FileStat, kind: str = "stat") -> str:
+    if kind == "content":
+        # Size, head and tail are enough to tell ebook files apart
+        digest = hashlib.sha256(str(stat.size).encode())
+        with fpath.open("rb") as f:
+            digest.update(f.read(CONTENT_FINGERPRINT_CHUNK_SIZE))
+            if stat.size > 2 * CONTENT_FINGERPRINT_CHUNK_SIZE:
+                f.seek(-CONTENT_FINGERPRINT_CHUNK_SIZE, os.SEEK_END)
+            digest.update(f.read(CONTENT_FINGERPRINT_CHUNK_SIZE))
+        return digest.hexdigest()
+    return f"{stat.size}:{stat.mtime_ns}:{stat.inode}"
+
+
+def get_metadata_cache_key(
+    files: list[Path], stats: dict[Path, FileStat] | None = None, kind: str = "stat"
+) -> str:
+    """Key of the file group in the metadata cache
+
+    The stat and content keys do not depend on file names, so moved or
+    renamed books still hit the cache, and they change when any file of the
+    group is replaced. The path key of older versions does not change then.
+    """
+    if kind in ("stat", "content"):
+        fingerprints = sorted(
+            get_file_fingerprint(f, get_file_stat(f, stats), kind) for f in files
+        )
+        return hashlib.sha256("\n".join(fingerprints).encode()).hexdigest()
+    return hashlib.md5(bytes(files[0])).hexdigest()  # nosec B324
+
+
+def get_evicted_keys(entries: list[tuple[float, str, int]], max_size: int) -> list[str]:
+    """Least recently used keys to remove to fit max_size bytes
+
+    Entries are (last access time, key, size) tuples.
+    """
+    result: list[str] = []
+    total = sum(size for (_, _, size) in entries)
+    for accessed, key, size in sorted(entries):
+        if total <= max_size:
+            break
+        result.append(key)
+        total -= size
+    return result
+
+
+def is_unused_share_exceeded(unused: int, total: int, max_share: float) -> bool:
+    # So many missing books rather mean an unmounted or moved library
+    if total and unused > total * max_share:
+        print(
+            f"Not removing {unused} of {total} cache entries of books which are"
+            " not in the library, increase cache_prune_limit to remove them"
+        )
+        return True
+    return False
+
+
+class MetadataCache:
+    """Metadata and covers extracted from ebook files
+
+    Covers are stored as thumbnails of the configured size and quality, so
+    they can be copied to the covers directory as they are. Thumbnails of
+    other settings are never used, the cover is extracted again instead.
+    """
+
+    config: Config
+    cover_params: str
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.cover_params = "{}x{}q{}".format(
+            config.cover_width, config.cover_height, config.cover_quality
+        )
+
+    def open(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        pass
+
+    def get_metadata(self, key: str) -> MetadataSidecarFile | None:
+        return None
+
+    def export_cover(self, key: str, fpath: Path) -> bool:
+        """Copy the stored thumbnail to fpath if it matches the settings"""
+        return False
+
+    def set_metadata(self, key: str, metadata: MetadataSidecarFile) -> None:
+        pass
+
+    def set_cover(self, key: str, data: bytes) -> None:
+        """Store the thumbnail, empty data marks ebooks without a cover"""
+        pass
+
+    def is_coverless(self, key: str) -> bool:
+        """Check if the ebook had no cover with the current cover settings"""
+        return False
+
+    def get_legacy_cover(self, key: str) -> CoverSidecarFile | None:
+        """Cover stored in its original size by older versions"""
+        return None
+
+    def remove(self, key: str) -> None:
+        pass
+
+    def get_failure(self, key: str) -> str | None:
+        """Reason why the file of the key couldn't be read before"""
+        return None
+
+    def set_failure(self, key: str, reason: str) -> None:
+        pass
+
+    def prune(
+        self,
+        keys: set[str],
+        remove_unused: bool = True,
+        max_size: int = 0,
+        max_unused_share: float = 1.0,
+    ) -> int:
+        """Remove entries of other keys and the least recently used entries
+
+        If max_size is set, entries of keys are marked as used now. If
+        remove_unused is true, entries of other keys are removed, unless they
+        are more than max_unused_share of all keys. Then the least recently
+        used entries are removed until the cache takes at most max_size
+        bytes. Return the number of removed keys.
+        """
+        return 0
+
+
+class FilesystemMetadataCache(MetadataCache):
+    """One .info and one .cover file per ebook in the cache directory"""
+
+    cache_dir: Path
+
+    def __init__(self, config: Config, cache_dir: Path):
+        super().__init__(config)
+        self.cache_dir = cache_dir
+
+    def get_metadata(self, key: str) -> MetadataSidecarFile | None:
+        metadata = get_metadata_sidecar_file(self.cache_dir / key)
+        if metadata.read():
+            return metadata
+        return None
+
+    def set_metadata(self, key: str, metadata: MetadataSidecarFile) -> None:
+        info = InfoSidecarFile((self.cache_dir / key).with_suffix(".info"))
+        info.read_dict(metadata.to_dict())
+        info.write()
+
+    def export_cover(self, key: str, fpath: Path) -> bool:
+        thumbnail_path = self._get_thumbnail_path(key)
+        try:
+            if not thumbnail_path.stat().st_size:
+                return False
+        except OSError:
+            return False
+        return copy_file(thumbnail_path, fpath, self.config.cover_copy_mode)
+
+    def set_cover(self, key: str, data: bytes) -> None:
+        replace_file(self._get_thumbnail_path(key), data)
+
+    def is_coverless(self, key: str) -> bool:
+        try:
+            return self._get_thumbnail_path(key).stat().st_size == 0
+        except OSError:
+            return False
+
+    def get_legacy_cover(self, key: str) -> CoverSidecarFile | None:
+        cover = get_cover_sidecar_file(
+            self.cache_dir / key, self.config.cover_width, self.config.cover_height
+        )
+        return cover if cover.read() else None
+
+    def remove(self, key: str) -> None:
+        fpaths = list(self.cache_dir.glob(f"{key}-*.cover"))
+        for suffix in (".info", ".cover", ".failed"):
+            fpaths.append(self.cache_dir / f"{key}{suffix}")
+        for fpath in fpaths:
+            try:
+                fpath.unlink(missing_ok=True)
+            except OSError:
+                pass
+
+    def get_failure(self, key: str) -> str | None:
+        try:
+            return (self.cache_dir / f"{key}.failed").read_text()
+        except OSError:
+            return None
+
+    def set_failure(self, key: str, reason: str) -> None:
+        try:
+            (self.cache_dir / f"{key}.failed").write_text(reason)
+        except OSError:
+            pass
+
+    def prune(
+        self,
+        keys: set[str],
+        remove_unused: bool = True,
+        max_size: int = 0,
+        max_unused_share: float = 1.0,
+    ) -> int:
+        entries: dict[str, list[Path]] = {}
+        stale_thumbnails: list[Path] = []
+        try:
+            for fpath in self.cache_dir.iterdir():
+                if fpath.suffix not in (".info", ".cover", ".failed"):
+                    continue
+                # Thumbnails are named key-params.cover, older covers key.cover
+                (key, _, params) = fpath.stem.partition("-")
+                if remove_unused and fpath.suffix == ".cover":
+                    if params != self.cover_params:
+                        # Thumbnails of other cover settings are never used
+                        stale_thumbnails.append(fpath)
+                        continue
+                entries.setdefault(key, []).append(fpath)
+        except OSError:
+            return 0
+
+        for fpath in stale_thumbnails:
+            fpath.unlink(missing_ok=True)
+
+        evicted: list[str] = []
+        if remove_unused:
+            evicted = [key for key in entries if key not in keys]
+            if is_unused_share_exceeded(len(evicted), len(entries), max_unused_share):
+                evicted = []
+
+        if max_size:
+            # Modification time of the entry files is the last access time
+            now = time.time()
+            used: list[tuple[float, str, int]] = []
+            unused = set(evicted)
+            for key, files in entries.items():
+                if key in unused:
+                    continue
+                accessed = 0.0
+                size = 0
+                for fpath in files:
+                    try:
+                        if key in keys:
+                            os.utime(fpath, (now, now))
+                        st = fpath.stat()
+                    except OSError:
+                        continue
+                    accessed = max(accessed, st.st_mtime)
+                    size += st.st_size
+                used.append((accessed, key, size))
+            evicted += get_evicted_keys(used, max_size)
+
+        for key in evicted:
+            for fpath in entries[key]:
+                fpath.unlink(missing_ok=True)
+        return len(evicted)
+
+    def _get_thumbnail_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}-{self.cover_params}.cover"
+
+
+class SqliteMetadataCache(MetadataCache):
+    """Single SQLite database with metadata and covers stored as BLOBs
+
+    Writes are queued and committed in batches. Caches of the filesystem
+    backend found next to the database are imported when it is created.
+    """
+
+    fpath: Path
+    connection: sqlite3.Connection | None
+    _pending_metadata: list[tuple[str, str]]
+    _pending_covers: list[tuple[str, bytes, str]]
+    _pending_failures: list[tuple[str, str]]
+    _pending_removals: list[tuple[str]]
+    _disabled: bool
+
+    def __init__(self, config: Config, fpath: Path):
+        super().__init__(config)
+        self.fpath = fpath
+        self.connection = None
+        self._pending_metadata = []
+        self._pending_covers = []
+        self._pending_failures = []
+        self._pending_removals = []
+        self._disabled = False
+
+    def open(self) -> bool:
+        if self.connection is not None:
+            return True
+        if self._disabled:
+            return False
+        try:
+            self.connection = sqlite3.connect(
+                self.fpath, timeout=60, isolation_level=None
+            )
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            imported = self._create_schema(self.connection)
+        except sqlite3.Error as e:
+            print(f"Can't open cache {self.fpath}: {e}")
+            self._disabled = True
+            self.close()
+            return False
+
+        for fpath in imported:
+            fpath.unlink(missing_ok=True)
+        return True
+
+    def close(self) -> None:
+        if self.connection is None:
+            return
+        try:
+            self.flush()
+        finally:
+            self.connection.close()
+            self.connection = None
+
+    def flush(self) -> None:
+        if self.connection is None:
+            return
+        pending = (
+            self._pending_metadata,
+            self._pending_covers,
+            self._pending_failures,
+            self._pending_removals,
+        )
+        if not any(pending):
+            return
+        try:
+            self.connection.execute("BEGIN IMMEDIATE")
+            for table in SQLITE_CACHE_TABLES:
+                self.connection.executemany(
+                    f"DELETE FROM {table} WHERE key = ?",  # nosec B608
+                    self._pending_removals,
+                )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO metadata (key, data) VALUES (?, ?)",
+                self._pending_metadata,
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO covers (key, data, params) VALUES (?, ?, ?)",
+                self._pending_covers,
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO failures (key, reason) VALUES (?, ?)",
+                self._pending_failures,
+            )
+            self.connection.execute("COMMIT")
+        except sqlite3.Error as e:
+            print(f"Can't write cache {self.fpath}: {e}")
+            if self.connection.in_transaction:
+                self.connection.execute("ROLLBACK")
+        finally:
+            self._pending_metadata.clear()
+            self._pending_covers.clear()
+            self._pending_failures.clear()
+            self._pending_removals.clear()
+
+    def get_metadata(self, key: str) -> MetadataSidecarFile | None:
+        if not self.open() or self.connection is None:
+            return None
+        row = self._fetchone("SELECT data FROM metadata WHERE key = ?", (key,))
+        if row is None:
+            return None
+        metadata = MetadataSidecarFile(self.fpath.with_name(key))
+        try:
+            metadata.read_dict(json.loads(row[0]))
+        except (TypeError, ValueError):
+            return None
+        return metadata
+
+    def set_metadata(self, key: str, metadata: MetadataSidecarFile) -> None:
+        if not self.open():
+            return
+        self._pending_metadata.append((key, json.dumps(metadata.to_dict())))
+        self._flush_full_batch()
+
+    def export_cover(self, key: str, fpath: Path) -> bool:
+        if not self.open() or self.connection is None:
+            return False
+        row = self._fetchone(
+            "SELECT data FROM covers WHERE key = ? AND params = ?",
+            (key, self.cover_params),
+        )
+        if row is None or not row[0]:
+            return False
+        return replace_file(fpath, row[0])
+
+    def set_cover(self, key: str, data: bytes) -> None:
+        if not self.open():
+            return
+        self._pending_covers.append((key, data, self.cover_params))
+        self._flush_full_batch()
+
+    def is_coverless(self, key: str) -> bool:
+        if not self.open() or self.connection is None:
+            return False
+        row = self._fetchone(
+            "SELECT 1 FROM covers WHERE key = ? AND params = ? AND length(data) = 0",
+            (key, self.cover_params),
+        )
+        return row is not None
+
+    def get_legacy_cover(self, key: str) -> CoverSidecarFile | None:
+        if not self.open() or self.connection is None:
+            return None
+        row = self._fetchone(
+            "SELECT data FROM covers WHERE key = ? AND params = ''", (key,)
+        )
+        if row is None:
+            return None
+        cover = CoverSidecarFile(self.fpath.with_name(key))
+        cover.cover_width = self.config.cover_width
+        cover.cover_height = self.config.cover_height
+        return cover if cover.read_bytes(row[0]) else None
+
+    def remove(self, key: str) -> None:
+        if not self.open():
+            return
+        self._pending_removals.append((key,))
+        self._flush_full_batch()
+
+    def get_failure(self, key: str) -> str | None:
+        if not self.open() or self.connection is None:
+            return None
+        row = self._fetchone("SELECT reason FROM failures WHERE key = ?", (key,))
+        return row[0] if row else None
+
+    def set_failure(self, key: str, reason: str) -> None:
+        if not self.open():
+            return
+        self._pending_failures.append((key, reason))
+        self._flush_full_batch()
+
+    def prune(
+        self,
+        keys: set[str],
+        remove_unused: bool = True,
+        max_size: int = 0,
+        max_unused_share: float = 1.0,
+    ) -> int:
+        if not self.open() or self.connection is None:
+            return 0
+        self.flush()
+        connection = self.connection
+        now = time.time_ns()
+        evicted: list[str] = []
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS used_keys (key TEXT PRIMARY KEY)"
+            )
+            connection.execute("DELETE FROM used_keys")
+            connection.executemany(
+                "INSERT OR IGNORE INTO used_keys (key) VALUES (?)",
+                ((key,) for key in keys),
+            )
+            if max_size:
+                # Access times are needed only for the size limit, updating
+                # them would rewrite every cover
+                for table in SQLITE_CACHE_TABLES:
+                    connection.execute(
+                        f"UPDATE {table} SET accessed = ?"  # nosec B608
+                        " WHERE key IN (SELECT key FROM used_keys)",
+                        (now,),
+                    )
+
+            condition = "WHERE key NOT IN (SELECT key FROM used_keys)"
+            if remove_unused:
+                rows = connection.execute(
+                    " UNION ".join(
+                        f"SELECT key FROM {table} {condition}"  # nosec B608
+                        for table in SQLITE_CACHE_TABLES
+                    )
+                )
+                evicted = [key for (key,) in rows]
+                (total,) = connection.execute(
+                    "SELECT COUNT(*) FROM ("
+                    + " UNION ".join(
+                        f"SELECT key FROM {table}"  # nosec B608
+                        for table in SQLITE_CACHE_TABLES
+                    )
+                    + ")"
+                ).fetchone()
+                if is_unused_share_exceeded(len(evicted), total, max_unused_share):
+                    evicted = []
+                else:
+                    for table in SQLITE_CACHE_TABLES:
+                        connection.execute(
+                            f"DELETE FROM {table} {condition}"  # nosec B608
+                        )
+
+            if max_size:
+                rows = connection.execute(
+                    "SELECT MAX(accessed), key, SUM(size) FROM ("
+                    " SELECT key, accessed, length(data) AS size FROM metadata"
+                    " UNION ALL SELECT key, accessed, length(data) FROM covers"
+                    " UNION ALL SELECT key, accessed, length(reason) FROM failures"
+                    ") GROUP BY key"
+                )
+                lru_evicted = get_evicted_keys(list(rows), max_size)
+                for table in SQLITE_CACHE_TABLES:
+                    connection.executemany(
+                        f"DELETE FROM {table} WHERE key = ?",  # nosec B608
+                        ((key,) for key in lru_evicted),
+                    )
+                evicted += lru_evicted
+            connection.execute("COMMIT")
+        except sqlite3.Error as e:
+            print(f"Can't prune cache {self.fpath}: {e}")
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            return 0
+
+        if evicted:
+            self._vacuum(connection)
+        return len(evicted)
+
+    def _fetchone(self, query: str, parameters: tuple[str, ...]) -> Any:
+        # A locked or broken database is handled as a cache miss
+        if self.connection is None:
+            return None
+        try:
+            return self.connection.execute(query, parameters).fetchone()
+        except sqlite3.Error as e:
+            print(f"Can't read cache {self.fpath}: {e}")
+            return None
+
+    def _vacuum(self, connection: sqlite3.Connection) -> None:
+        # Free pages are reused by later writes, the file is shrunk only when
+        # a large part of it is free
+        try:
+            (page_count,) = connection.execute("PRAGMA page_count").fetchone()
+            (freelist_count,) = connection.execute("PRAGMA freelist_count").fetchone()
+            if freelist_count * 4 > page_count:
+                connection.execute("VACUUM")
+        except sqlite3.Error as e:
+            print(f"Can't vacuum cache {self.fpath}: {e}")
+
+    def _flush_full_batch(self) -> None:
+        pending = (
+            len(self._pending_metadata)
+            + len(self._pending_covers)
+            + len(self._pending_failures)
+            + len(self._pending_removals)
+        )
+        if pending >= SQLITE_CACHE_BATCH_SIZE:
+            self.flush()
+
+    def _create_schema(self, connection: sqlite3.Connection) -> list[Path]:
+        imported: list[Path] = []
+        # Lock the database, so concurrent processes create it only once
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            (version,) = connection.execute("PRAGMA user_version").fetchone()
+            if version == 0:
+                connection.execute(
+                    "CREATE TABLE metadata (key TEXT PRIMARY KEY, data TEXT NOT NULL)"
+                )
+                connection.execute(
+                    "CREATE TABLE covers (key TEXT PRIMARY KEY, data BLOB NOT NULL,"
+                    " params TEXT NOT NULL DEFAULT '')"
+                )
+            elif version == 1:
+                # Covers of version 1 were stored in their original size
+                connection.execute(
+                    "ALTER TABLE covers ADD COLUMN params TEXT NOT NULL DEFAULT ''"
+                )
+            if version < 3:
+                connection.execute(
+                    "CREATE TABLE failures (key TEXT PRIMARY KEY, reason TEXT NOT NULL)"
+                )
+            if version < 4:
+                # Last access times for the size limit of the cache
+                for table in SQLITE_CACHE_TABLES:
+                    connection.execute(
+                        f"ALTER TABLE {table} ADD COLUMN"  # nosec B608
+                        " accessed INTEGER NOT NULL DEFAULT 0"
+                    )
+            if version == 0:
+                imported = self._import_files(connection)
+            if version < SQLITE_CACHE_VERSION:
+                connection.execute(f"PRAGMA user_version = {SQLITE_CACHE_VERSION}")
+            connection.execute("COMMIT")
+        except sqlite3.Error:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise
+        return imported
+
+    def _import_files(self, connection: sqlite3.Connection) -> list[Path]:
+        imported: list[Path] = []
+        for fpath in self.fpath.parent.glob("*.info"):
+            metadata = InfoSidecarFile(fpath)
+            try:
+                if not metadata.read():
+                    continue
+            except (KeyError, configparser.Error):
+                continue
+            connection.execute(
+                "INSERT OR REPLACE INTO metadata (key, data) VALUES (?, ?)",
+                (fpath.stem, json.dumps(metadata.to_dict())),
+            )
+            imported.append(fpath)
+        for fpath in self.fpath.parent.glob("*.cover"):
+            try:
+                data = fpath.read_bytes()
+            except OSError:
+                continue
+            # Thumbnails are named key-params.cover, older covers key.cover
+            (key, _, params) = fpath.stem.partition("-")
+            connection.execute(
+                "INSERT OR REPLACE INTO covers (key, data, params) VALUES (?, ?, ?)",
+                (key, data, params),
+            )
+            imported.append(fpath)
+        for fpath in self.fpath.parent.glob("*.failed"):
+            try:
+                reason = fpath.read_text()
+            except OSError:
+                continue
+            connection.execute(
+                "INSERT OR REPLACE INTO failures (key, reason) VALUES (?, ?)",
+                (fpath.stem, reason),
+            )
+            imported.append(fpath)
+        return imported
+
+
+def get_metadata_cache(config: Config) -> MetadataCache | None:
+    if not config.cache_dir or not config.cache_dir.exists():
+        return None
+    if config.cache_backend == "files":
+        return FilesystemMetadataCache(config, config.cache_dir)
+    return SqliteMetadataCache(config, config.cache_dir / SQLITE_CACHE_FILENAME)
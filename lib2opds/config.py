@@ -5,6 +5,14 @@ from datetime import datetime
 from pathlib import Path
 from urllib.parse import urljoin
 
+# Allowed values of str fields which select an implementation
+CHOICE_FIELDS: dict[str, tuple[str, ...]] = {
+    "cache_backend": ("sqlite", "files"),
+    "cache_key": ("stat", "path", "content"),
+    "cover_copy_mode": ("copy", "hardlink", "reflink"),
+    "publish_mode": ("inplace", "staged"),
+}
+
 
 @dataclass
 class Config:
@@ -28,7 +36,14 @@ class Config:
     feed_by_issued_date_title: str = "Issued"
     feed_random_book_title: str = "Random Book"
     cache_dir: Path | None = None
+    cache_backend: str = "sqlite"
+    cache_key: str = "stat"
+    cover_copy_mode: str = "copy"
+    cache_prune: bool = True
+    cache_prune_limit: int = 50
+    cache_max_size: int = 0
     invalidate_cache: bool = False
+    retry_failed: bool = False
     index_filename: str = "index.html"
     generate_site: bool = False
     generate_site_xslt: bool = False
@@ -37,15 +52,48 @@ class Config:
     generate_random_book_feed: bool = True
     pages_dir: Path = Path("pages")
     assets_dir: Path = Path("assets")
+    jobs: int = 1
+    export_jobs: int = 1
+    check_file_changes: bool = True
+    sidecar_fallback_fields: list[str] = field(default_factory=list)
+    ebook_cover_fallback: bool = True
+    read_timeout: float = 0
+    read_memory_limit: int = 0
+    publish_mode: str = "inplace"
+    changed_paths_file: Path | None = None
+    delta_dir: Path | None = None
+    delta_tar: bool = True
+    shard_depth: int = 0
+    page_size: int = 0
+    # Directory the catalog is written to by a staged publish
+    staging_dir: Path | None = None
+
+    def get_output_dir(self) -> Path:
+        return self.staging_dir if self.staging_dir else self.opds_dir
 
     def get_feeds_dir(self) -> Path:
-        return self.opds_dir / self.feeds_dir
+        return self.get_output_dir() / self.feeds_dir
 
     def get_pages_dir(self) -> Path:
-        return self.opds_dir / self.pages_dir
+        return self.get_output_dir() / self.pages_dir
 
     def get_assets_dir(self) -> Path:
-        return self.opds_dir / self.assets_dir
+        return self.get_output_dir() / self.assets_dir
+
+    def get_shard_path(self, dirpath: Path, filename: str) -> Path:
+        """Path of the file in subdirectories named by its first characters
+
+        Feed and publication IDs are UUIDs, so the files are spread evenly,
+        e.g. covers/ab/cd/abcd1234-....jpg with depth 2.
+        """
+        for i in range(min(self.shard_depth, 4)):
+            dirpath = dirpath / filename[i * 2 : i * 2 + 2]
+        return dirpath / filename
+
+    def get_manifest_path(self, filename: str = "manifest.json") -> Path | None:
+        if self.cache_dir and self.cache_dir.exists():
+            return self.cache_dir / filename
+        return None
 
     def get_assets_uri(self) -> str:
         return urljoin(self.opds_base_uri, str(self.assets_dir))
@@ -72,10 +120,23 @@ class Config:
             "feed_by_author_title",
             "feed_by_language_title",
             "index_filename",
+            "cache_backend",
+            "cache_key",
+            "cover_copy_mode",
+            "publish_mode",
         )
 
         for str_field in str_fields:
             if str_value := config["General"].get(str_field):
+                if str_value not in CHOICE_FIELDS.get(str_field, (str_value,)):
+                    raise ValueError(
+                        "Unknown {} {!r} in {}, expected one of: {}".format(
+                            str_field,
+                            str_value,
+                            config_path,
+                            ", ".join(CHOICE_FIELDS[str_field]),
+                        )
+                    )
                 self._update_str_field(str_field, str_value)
 
         self.opds_dir = Path(config["General"].get("opds_dir", ""))
@@ -98,6 +159,39 @@ class Config:
             "publication_freshness_days", 14
         )
         self.cover_quality = config["General"].getint("cover_quality", 70)
+        self.jobs = config["General"].getint("jobs", 1)
+        self.export_jobs = config["General"].getint("export_jobs", 1)
+        self.check_file_changes = config["General"].getboolean("check_file_changes", True)
+        self.cache_prune = config["General"].getboolean("cache_prune", True)
+        self.cache_prune_limit = config["General"].getint("cache_prune_limit", 50)
+        self.cache_max_size = config["General"].getint("cache_max_size", 0)
+        self.shard_depth = config["General"].getint("shard_depth", 0)
+        self.page_size = config["General"].getint("page_size", 0)
+        for int_field in ("shard_depth", "page_size"):
+            if getattr(self, int_field) < 0:
+                raise ValueError(
+                    "Negative {} {} in {}".format(
+                        int_field, getattr(self, int_field), config_path
+                    )
+                )
+
+        self.sidecar_fallback_fields = [
+            f.strip()
+            for f in config["General"].get("sidecar_fallback_fields", "").split(",")
+            if f.strip()
+        ]
+        self.ebook_cover_fallback = config["General"].getboolean(
+            "ebook_cover_fallback", True
+        )
+        self.read_timeout = config["General"].getfloat("read_timeout", 0)
+        self.read_memory_limit = config["General"].getint("read_memory_limit", 0)
+
+        if changed_paths_file := config["General"].get("changed_paths_file", ""):
+            self.changed_paths_file = Path(changed_paths_file)
+
+        if delta_dir := config["General"].get("delta_dir", ""):
+            self.delta_dir = Path(delta_dir)
+        self.delta_tar = config["General"].getboolean("delta_tar", True)
 
         if cache_dir := config["General"].get("cache_dir", ""):
             self.cache_dir = Path(cache_dir)
@@ -121,9 +215,19 @@ class Config:
             self.cache_dir = Path(args.cache_dir)
         if args.invalidate_cache:
             self.invalidate_cache = args.invalidate_cache
+        if args.retry_failed:
+            self.retry_failed = args.retry_failed
         if args.generate_site:
             self.generate_site = args.generate_site
         if args.generate_site_xslt:
             self.generate_site_xslt = args.generate_site_xslt
+        if args.jobs:
+            self.jobs = args.jobs
+        if args.export_jobs:
+            self.export_jobs = args.export_jobs
+        if args.delta_dir:
+            self.delta_dir = Path(args.delta_dir)
+        if args.changed_paths_file:
+            self.changed_paths_file = Path(args.changed_paths_file)
 
         return True
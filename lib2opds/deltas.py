@@ -0,0 +1,162 @@
+import json
+import os
+import tarfile
+from datetime import datetime
+from pathlib import Path, PurePosixPath
+from typing import Any, Iterator
+
+from lib2opds.outputs import OutputWriter, get_content_hash
+from lib2opds.publishers import replace_file
+
+DELTA_VERSION = 1
+
+
+def write_delta(
+    output: OutputWriter, delta_dir: Path, with_tar: bool = True
+) -> Path | None:
+    """Write changes of the run as name.json with an optional name.tar
+
+    The JSON file is written last, so a mirror which finds it can rely on
+    the tar file being complete. Return the path of the JSON file.
+    """
+    changes = output.get_changes()
+    if not changes:
+        return None
+
+    name = "delta-" + datetime.now().strftime("%Y%m%dT%H%M%S%f")
+    tar_fpath: Path | None = None
+    try:
+        delta_dir.mkdir(parents=True, exist_ok=True)
+        if with_tar:
+            tar_fpath = delta_dir / f"{name}.tar"
+            tmp_fpath = tar_fpath.with_name(f".{tar_fpath.name}.tmp")
+            with tarfile.open(tmp_fpath, "w") as tar:
+                for path, change in sorted(changes.items()):
+                    if change["new"] is not None:
+                        tar.add(output.root / path, arcname=path, recursive=False)
+            os.replace(tmp_fpath, tar_fpath)
+    except (OSError, tarfile.TarError) as e:
+        print(f"Can't write delta to {delta_dir}: {e}")
+        return None
+
+    data = {
+        "version": DELTA_VERSION,
+        "tar": tar_fpath.name if tar_fpath else None,
+        "files": changes,
+    }
+    fpath = delta_dir / f"{name}.json"
+    if not replace_file(fpath, json.dumps(data, indent=1, sort_keys=True)):
+        print(f"Can't write delta to {delta_dir}")
+        return None
+    return fpath
+
+
+def get_file_hash(fpath: Path) -> str | None:
+    try:
+        return get_content_hash(fpath.read_bytes())
+    except OSError:
+        return None
+
+
+def is_safe_path(path: str) -> bool:
+    p = PurePosixPath(path)
+    return bool(path) and not p.is_absolute() and ".." not in p.parts
+
+
+def read_delta(fpath: Path) -> dict[str, Any] | None:
+    try:
+        with fpath.open() as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get("version") != DELTA_VERSION:
+        return None
+    if not isinstance(data.get("files"), dict):
+        return None
+    return data
+
+
+def apply_delta(
+    fpath: Path, target_dir: Path, source_dir: Path | None = None, force: bool = False
+) -> bool:
+    """Apply the delta written by write_delta to a copy of the catalog
+
+    Files are taken from the tar file of the delta or from source_dir. Their
+    content hashes are verified before anything in target_dir is replaced.
+    Unless force is true, the delta is applied only if target_dir has the
+    content the delta was made against.
+    """
+    if (data := read_delta(fpath)) is None:
+        print(f"Can't read delta {fpath}")
+        return False
+    files: dict[str, dict[str, str | None]] = data["files"]
+
+    for path, change in files.items():
+        if not is_safe_path(path):
+            print(f"Can't apply delta {fpath}: unsafe path {path}")
+            return False
+        if force:
+            continue
+        current = get_file_hash(target_dir / path)
+        # A delta which is applied again finds the new content
+        if current not in (change["old"], change["new"]):
+            print(f"Can't apply delta {fpath}: {path} differs from the delta base")
+            return False
+
+    # New files are staged next to their targets and renamed at the end
+    staged: dict[Path, Path] = {}
+    try:
+        for path, content in iter_delta_contents(fpath, data, source_dir):
+            if get_content_hash(content) != files[path]["new"]:
+                print(f"Can't apply delta {fpath}: hash mismatch for {path}")
+                return False
+            local_path = target_dir / path
+            tmp_path = local_path.with_name(f".{local_path.name}.delta")
+            local_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path.write_bytes(content)
+            staged[local_path] = tmp_path
+
+        missing = [
+            path
+            for path, change in files.items()
+            if change["new"] is not None and target_dir / path not in staged
+        ]
+        if missing:
+            print(f"Can't apply delta {fpath}: {missing[0]} is missing")
+            return False
+
+        for local_path, tmp_path in staged.items():
+            os.replace(tmp_path, local_path)
+        staged = {}
+        for path, change in files.items():
+            if change["new"] is None:
+                (target_dir / path).unlink(missing_ok=True)
+    except (OSError, tarfile.TarError) as e:
+        print(f"Can't apply delta {fpath}: {e}")
+        return False
+    finally:
+        for tmp_path in staged.values():
+            tmp_path.unlink(missing_ok=True)
+    return True
+
+
+def iter_delta_contents(
+    fpath: Path, data: dict[str, Any], source_dir: Path | None = None
+) -> Iterator[tuple[str, bytes]]:
+    """Yield (path, content) of added and changed files of the delta"""
+    files: dict[str, dict[str, str | None]] = data["files"]
+    if source_dir is not None:
+        for path, change in files.items():
+            if change["new"] is not None:
+                yield (path, (source_dir / path).read_bytes())
+        return
+
+    if not data.get("tar"):
+        raise OSError("delta has no tar file, use --source")
+    with tarfile.open(fpath.with_name(data["tar"])) as tar:
+        for member in tar:
+            if not member.isfile() or not files.get(member.name, {}).get("new"):
+                continue
+            f = tar.extractfile(member)
+            if f is not None:
+                yield (member.name, f.read())
@@ -14,19 +14,21 @@ def get_mimetype_by_filename(fpath: Path) -> str:
     return pub_mimetype if pub_mimetype else ""
 
 
-def get_ebook_file_by_suffix(fpath: Path) -> EbookFile | None:
+def get_ebook_file_by_suffix(
+    fpath: Path, cover_size: tuple[int, int] | None = None
+) -> EbookFile | None:
     mimetype: str | None = get_mimetype_by_filename(fpath)
 
     if mimetype is None:
         return None
     if mimetype == EpubFile.mimetype:
-        f = EpubFile(fpath)
+        f = EpubFile(fpath, cover_size)
         return f
     elif mimetype == PdfFile.mimetype:
-        p = PdfFile(fpath)
+        p = PdfFile(fpath, cover_size)
         return p
     elif mimetype == M4bFile.mimetype:
-        m = M4bFile(fpath)
+        m = M4bFile(fpath, cover_size)
         return m
     else:
         return None
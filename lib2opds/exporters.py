@@ -0,0 +1,171 @@
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterator, TypeVar
+
+from lib2opds.config import Config
+from lib2opds.feeds import AcquisitionFeed, AtomFeed, render_entry
+from lib2opds.fragments import FragmentCache
+from lib2opds.outputs import OutputWriter, write_hashed_temp_file
+from lib2opds.publications import Publication
+
+EXPORT_CHUNK_SIZE = 64
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Workers are forked after these are set, so they inherit the catalog instead
+# of receiving it with every task
+_feeds: list[AtomFeed] = []
+_publications: list[Publication] = []
+_fragments: FragmentCache | None = None
+
+
+def render_entries(tasks: list[tuple[int, str]]) -> list[str]:
+    """Render (publication index, kind) entries in a worker"""
+    return [render_entry(_publications[index], kind) for index, kind in tasks]
+
+
+def render_pages(
+    tasks: list[tuple[int, str, int]],
+) -> list[tuple[Path, Path | None, str]]:
+    """Render (feed index, kind, page) pages in a worker
+
+    Pages are streamed to temporary files, only their paths and content
+    hashes are sent back.
+    """
+    fragments = _fragments if _fragments is not None else FragmentCache()
+    result: list[tuple[Path, Path | None, str]] = []
+    for index, kind, page in tasks:
+        feed = _feeds[index]
+        fpath = feed.get_local_path(kind, page)
+        try:
+            (tmp_fpath, content_hash) = write_hashed_temp_file(
+                fpath, feed.render(kind, page, fragments)
+            )
+        except OSError:
+            result.append((fpath, None, ""))
+            continue
+        result.append((fpath, tmp_fpath, content_hash))
+    return result
+
+
+def map_chunks(
+    func: Callable[[list[T]], R], tasks: list[T], jobs: int
+) -> Iterator[tuple[list[T], R]]:
+    """Run func on chunks of tasks in forked workers, yield results in order
+
+    Only a few chunks are rendered ahead, so results don't pile up in
+    memory while the caller handles them.
+    """
+    if not tasks:
+        return
+    size = max(1, min(EXPORT_CHUNK_SIZE, len(tasks) // (jobs * 4)))
+    chunks = [tasks[i : i + size] for i in range(0, len(tasks), size)]
+    with ProcessPoolExecutor(
+        max_workers=jobs, mp_context=multiprocessing.get_context("fork")
+    ) as executor:
+        pending: deque[tuple[list[T], Future[R]]] = deque()
+        for chunk in chunks:
+            pending.append((chunk, executor.submit(func, chunk)))
+            if len(pending) > jobs * 2:
+                chunk, future = pending.popleft()
+                yield (chunk, future.result())
+        while pending:
+            chunk, future = pending.popleft()
+            yield (chunk, future.result())
+
+
+def write_page(
+    fpath: Path,
+    tmp_fpath: Path | None,
+    content_hash: str,
+    output: OutputWriter | None = None,
+) -> bool:
+    """Move the page rendered by a worker into place"""
+    if tmp_fpath is None:
+        return False
+    if output:
+        return output.replace(fpath, tmp_fpath, content_hash)
+    try:
+        os.replace(tmp_fpath, fpath)
+    except OSError:
+        tmp_fpath.unlink(missing_ok=True)
+        return False
+    return True
+
+
+def export_feeds(
+    config: Config,
+    catalog: AtomFeed,
+    kinds: list[str],
+    output: OutputWriter | None = None,
+    fragments: FragmentCache | None = None,
+) -> None:
+    """Write feeds of the catalog as kinds, xml or html
+
+    With more than one export job, entries missing in fragments and then
+    pages are rendered by worker processes, which stream pages to
+    temporary files renamed in place here. Files are the same as written
+    by the sequential export.
+    """
+    global _feeds, _publications, _fragments
+    jobs = config.export_jobs
+    if jobs <= 1:
+        for kind in kinds:
+            if kind == "html":
+                catalog.export_as_html(True, output, fragments)
+            else:
+                catalog.export_as_xml(True, output, fragments)
+        return
+
+    feeds = catalog.get_all_feeds()
+    page_tasks = [
+        (index, kind, page)
+        for kind in kinds
+        for index, feed in enumerate(feeds)
+        for page in feed.get_pages_to_export(kind)
+    ]
+    if not page_tasks:
+        return
+    if fragments is None:
+        fragments = FragmentCache()
+
+    # Each entry is rendered once, even if its book is listed in feeds
+    # rendered by different workers
+    publications: list[Publication] = []
+    entry_tasks: list[tuple[int, str]] = []
+    seen: set[tuple[str, str]] = set()
+    for index, kind in dict.fromkeys((index, kind) for index, kind, _ in page_tasks):
+        feed = feeds[index]
+        if not isinstance(feed, AcquisitionFeed):
+            continue
+        for p in feed.publications:
+            if (p._id, kind) in seen:
+                continue
+            seen.add((p._id, kind))
+            if fragments.get_entry(p, kind) is None:
+                entry_tasks.append((len(publications), kind))
+                publications.append(p)
+
+    # Workers must not inherit an open connection to the database
+    fragments.close()
+    _feeds = feeds
+    _publications = publications
+    try:
+        for chunk, entries in map_chunks(render_entries, entry_tasks, jobs):
+            for (index, kind), entry in zip(chunk, entries):
+                fragments.set_entry(publications[index], kind, entry)
+
+        # Workers of pages find all entries in memory
+        fragments.close()
+        _fragments = fragments
+        for _, pages in map_chunks(render_pages, page_tasks, jobs):
+            for fpath, tmp_fpath, content_hash in pages:
+                write_page(fpath, tmp_fpath, content_hash, output)
+    finally:
+        _feeds = []
+        _publications = []
+        _fragments = None
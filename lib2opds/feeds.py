@@ -1,19 +1,55 @@
+import hashlib
 import uuid
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Self
+from typing import Iterable, Iterator, Self
 from urllib.parse import quote, urljoin
 
 from jinja2 import Environment, PackageLoader, select_autoescape
 
 from lib2opds.config import Config
+from lib2opds.fragments import FragmentCache
+from lib2opds.outputs import OutputWriter
 from lib2opds.publications import Publication
+from lib2opds.publishers import replace_file
 
 env = Environment(loader=PackageLoader("lib2opds"), autoescape=select_autoescape())
+ENTRY_TEMPLATES = ("acquisition-entry.xml", "acquisition-entry.html")
 
 
-def get_id() -> str:
+def get_entry_version() -> str:
+    """Digest of the entry templates for keys of stored entries"""
+    digest = hashlib.sha256()
+    if env.loader is not None:
+        for name in ENTRY_TEMPLATES:
+            digest.update(env.loader.get_source(env, name)[0].encode())
+    return digest.hexdigest()
+
+
+def render_entry(p: Publication, kind: str) -> str:
+    template = env.get_template(f"acquisition-entry.{kind}")
+    return template.render(publication=p)
+
+
+def get_publication_sort_key(p: Publication) -> str:
+    return p.title.lower()
+
+
+def get_feed_sort_key(feed: "AtomFeed") -> str:
+    return feed.title.lower()
+
+
+@dataclass
+class FeedPage:
+    number: int
+    count: int
+    publications: Iterable[Publication]
+
+
+def get_id(key: str = "") -> str:
+    if key:
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, "lib2opds:feed:" + key))
     return str(uuid.uuid4())
 
 
@@ -25,12 +61,55 @@ class AtomFeed:
     title: str = ""
     id: str = field(default_factory=get_id)
     updated: str = datetime.now().isoformat(timespec="seconds")
+    key: str = ""
+    changed: bool = True
 
-    def export_as_xml(self, recursive: bool = True) -> bool:
+    def __post_init__(self) -> None:
+        if self.key:
+            self.id = get_id(self.key)
+
+    def export_as_xml(
+        self,
+        recursive: bool = True,
+        output: OutputWriter | None = None,
+        fragments: FragmentCache | None = None,
+    ) -> bool:
         raise NotImplementedError(
             "AtomFeed.export_as_xml should be implement in child class"
         )
 
+    def is_export_needed(self, local_path: Path) -> bool:
+        return self.changed or not local_path.exists()
+
+    def get_pages_to_export(self, kind: str) -> list[int]:
+        """Numbers of pages to write as kind, all of them if any is needed"""
+        pages = range(1, self.get_page_count() + 1)
+        if any(self.is_export_needed(self.get_local_path(kind, n)) for n in pages):
+            return list(pages)
+        return []
+
+    def render(
+        self, kind: str, page: int = 1, fragments: FragmentCache | None = None
+    ) -> Iterator[str]:
+        """Chunks of the page rendered as kind, xml or html"""
+        raise NotImplementedError("AtomFeed.render should be implement in child class")
+
+    def sort(self, recursive: bool = True) -> None:
+        raise NotImplementedError("AtomFeed.sort should be implement in child class")
+
+    def get_page_count(self) -> int:
+        return 1
+
+    def write(
+        self,
+        local_path: Path,
+        data: str | Iterable[str],
+        output: OutputWriter | None = None,
+    ) -> bool:
+        if output:
+            return output.write(local_path, data)
+        return replace_file(local_path, data)
+
     def is_root(self) -> bool:
         return self.root == None
 
@@ -43,31 +122,47 @@ class AtomFeed:
             local_path = self.get_local_path_xml()
             return local_path.name.capitalize()
 
-    def get_local_path_xml(self) -> Path:
-        if not self.is_root():
-            return self.config.get_feeds_dir() / Path(str(self.id) + ".xml")
+    def get_local_path_xml(self, page: int = 1) -> Path:
+        if not self.is_root() or page > 1:
+            return self.config.get_shard_path(
+                self.config.get_feeds_dir(), self._get_page_name(page) + ".xml"
+            )
         else:
-            return self.config.opds_dir / self.config.root_filename
+            return self.config.get_output_dir() / self.config.root_filename
 
-    def get_local_path_html(self) -> Path:
-        if not self.is_root():
-            return self.config.get_pages_dir() / Path(str(self.id) + ".html")
+    def get_local_path_html(self, page: int = 1) -> Path:
+        if not self.is_root() or page > 1:
+            return self.config.get_shard_path(
+                self.config.get_pages_dir(), self._get_page_name(page) + ".html"
+            )
         else:
-            return self.config.opds_dir / self.config.index_filename
+            return self.config.get_output_dir() / self.config.index_filename
+
+    def get_local_path(self, kind: str, page: int = 1) -> Path:
+        if kind == "html":
+            return self.get_local_path_html(page)
+        return self.get_local_path_xml(page)
+
+    def get_local_paths(self) -> list[Path]:
+        result: list[Path] = []
+        for page in range(1, self.get_page_count() + 1):
+            result.append(self.get_local_path_xml(page))
+            result.append(self.get_local_path_html(page))
+        return result
 
-    def get_link_self_href_xml(self) -> str:
-        local_path = self.get_local_path_xml()
+    def get_link_self_href_xml(self, page: int = 1) -> str:
+        local_path = self.get_local_path_xml(page)
         link_self_href = urljoin(
             str(self.config.opds_base_uri),
-            str(local_path.relative_to(self.config.opds_dir)),
+            str(local_path.relative_to(self.config.get_output_dir())),
         )
         return link_self_href
 
-    def get_link_self_href_html(self) -> str:
-        local_path = self.get_local_path_html()
+    def get_link_self_href_html(self, page: int = 1) -> str:
+        local_path = self.get_local_path_html(page)
         link_self_href = urljoin(
             str(self.config.opds_base_uri),
-            str(local_path.relative_to(self.config.opds_dir)),
+            str(local_path.relative_to(self.config.get_output_dir())),
         )
         return link_self_href
 
@@ -76,7 +171,33 @@ class AtomFeed:
         # TODO
         return result
 
-    def export_as_html(self, recursive: bool = True) -> bool:
+    def get_all_feeds(self) -> list["AtomFeed"]:
+        """This feed and all feeds below it in the order of export"""
+        return [self]
+
+    def _get_page_name(self, page: int) -> str:
+        # The first page keeps the name of an unpaginated feed
+        return str(self.id) if page == 1 else f"{self.id}-{page}"
+
+    def _export(
+        self,
+        kind: str,
+        output: OutputWriter | None = None,
+        fragments: FragmentCache | None = None,
+    ) -> bool:
+        if fragments is None:
+            fragments = FragmentCache()
+        for page in self.get_pages_to_export(kind):
+            data = self.render(kind, page, fragments)
+            self.write(self.get_local_path(kind, page), data, output)
+        return True
+
+    def export_as_html(
+        self,
+        recursive: bool = True,
+        output: OutputWriter | None = None,
+        fragments: FragmentCache | None = None,
+    ) -> bool:
         raise NotImplementedError(
             "AtomFeed.export_as_xml should be implement in child class"
         )
@@ -87,26 +208,67 @@ class AcquisitionFeed(AtomFeed):
     publications: list[Publication] = field(default_factory=list)
     kind: str = "acquisition"
 
-    def export_as_xml(self, recursive: bool = False) -> bool:
-        template = env.get_template("acquisition-feed.xml")
-        data = template.render(feed=self)
-        local_path = self.get_local_path_xml()
-        local_path.parent.mkdir(parents=True, exist_ok=True)
-        with local_path.open(mode="w") as f:
-            f.write(data)
-        return True
+    def export_as_xml(
+        self,
+        recursive: bool = False,
+        output: OutputWriter | None = None,
+        fragments: FragmentCache | None = None,
+    ) -> bool:
+        return self._export("xml", output, fragments)
 
     def get_all_publications(self) -> list[Publication]:
         return self.publications
 
-    def export_as_html(self, recursive: bool = False) -> bool:
-        template = env.get_template("acquisition-feed.html")
-        data = template.render(feed=self)
-        local_path = self.get_local_path_html()
-        local_path.parent.mkdir(parents=True, exist_ok=True)
-        with local_path.open(mode="w") as f:
-            f.write(data)
-        return True
+    def render(
+        self, kind: str, page: int = 1, fragments: FragmentCache | None = None
+    ) -> Iterator[str]:
+        template = env.get_template(f"acquisition-feed.{kind}")
+        return template.generate(
+            feed=self,
+            page=self.get_page(page),
+            fragments=fragments if fragments is not None else FragmentCache(),
+        )
+
+    def get_entry(self, p: Publication, kind: str, fragments: FragmentCache) -> str:
+        """Entry of the publication rendered with acquisition-entry.kind
+
+        Entries don't depend on the feed, so each one is rendered once.
+        """
+        if (entry := fragments.get_entry(p, kind)) is None:
+            entry = render_entry(p, kind)
+            fragments.set_entry(p, kind, entry)
+        return entry
+
+    def sort(self, recursive: bool = True) -> None:
+        self.publications.sort(key=get_publication_sort_key)
+
+    def get_page_count(self) -> int:
+        if not self.config.page_size:
+            return 1
+        return max(1, -(-len(self.publications) // self.config.page_size))
+
+    def get_page(self, number: int) -> FeedPage:
+        """Page of publications, numbered from 1
+
+        Publications are expected to be sorted with sort() beforehand. Pages
+        iterate over the list, so publications are not copied per page.
+        """
+        publications = self.publications
+        size = self.config.page_size or len(publications)
+        indexes = range((number - 1) * size, min(number * size, len(publications)))
+        return FeedPage(number, self.get_page_count(), (publications[i] for i in indexes))
+
+    def get_pages(self) -> Iterator[FeedPage]:
+        for number in range(1, self.get_page_count() + 1):
+            yield self.get_page(number)
+
+    def export_as_html(
+        self,
+        recursive: bool = False,
+        output: OutputWriter | None = None,
+        fragments: FragmentCache | None = None,
+    ) -> bool:
+        return self._export("html", output, fragments)
 
 
 @dataclass
@@ -114,16 +276,19 @@ class NavigationFeed(AtomFeed):
     entries: list[AcquisitionFeed | Self] = field(default_factory=list)
     kind: str = "navigation"
 
-    def export_as_xml(self, recursive: bool = True) -> bool:
-        template = env.get_template("navigation-feed.xml")
-        data = template.render(feed=self)
-        local_path = self.get_local_path_xml()
-        local_path.parent.mkdir(parents=True, exist_ok=True)
-        with local_path.open(mode="w") as f:
-            f.write(data)
+    def export_as_xml(
+        self,
+        recursive: bool = True,
+        output: OutputWriter | None = None,
+        fragments: FragmentCache | None = None,
+    ) -> bool:
+        self._export("xml", output, fragments)
         if recursive:
+            # Entries of publications are shared by all acquisition feeds
+            if fragments is None:
+                fragments = FragmentCache()
             for entry in self.entries:
-                entry.export_as_xml(recursive)
+                entry.export_as_xml(recursive, output, fragments)
         return True
 
     def get_all_publications(self) -> list[Publication]:
@@ -132,15 +297,37 @@ class NavigationFeed(AtomFeed):
             result.extend(e.get_all_publications())
         return result
 
-    def export_as_html(self, recursive: bool = True) -> bool:
-        template = env.get_template("navigation-feed.html")
-        data = template.render(feed=self)
-        local_path = self.get_local_path_html()
-        local_path.parent.mkdir(parents=True, exist_ok=True)
+    def get_all_feeds(self) -> list[AtomFeed]:
+        result: list[AtomFeed] = [self]
+        for entry in self.entries:
+            result.extend(entry.get_all_feeds())
+        return result
+
+    def render(
+        self, kind: str, page: int = 1, fragments: FragmentCache | None = None
+    ) -> Iterator[str]:
+        template = env.get_template(f"navigation-feed.{kind}")
+        return template.generate(feed=self)
+
+    def sort(self, recursive: bool = True) -> None:
+        # Entries of the root keep the order they were added in
+        if not self.is_root():
+            self.entries.sort(key=get_feed_sort_key)
+        if recursive:
+            for entry in self.entries:
+                entry.sort(recursive)
 
-        with local_path.open(mode="w") as f:
-            f.write(data)
+    def export_as_html(
+        self,
+        recursive: bool = True,
+        output: OutputWriter | None = None,
+        fragments: FragmentCache | None = None,
+    ) -> bool:
+        self._export("html", output, fragments)
         if recursive:
+            # Entries of publications are shared by all acquisition feeds
+            if fragments is None:
+                fragments = FragmentCache()
             for entry in self.entries:
-                entry.export_as_html(recursive)
+                entry.export_as_html(recursive, output, fragments)
         return True
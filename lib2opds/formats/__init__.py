@@ -11,14 +11,20 @@ from lib2opds.sidecars import (
 
 class EbookFile(ABC):
     fpath: Path
+    cover_size: tuple[int, int] | None
     metadata_quality_score: int = 0
+    # Bytes read from the file by the last read()
+    bytes_read: int = 0
     _metadata_file: MetadataSidecarFile
     _cover_file: CoverSidecarFile
 
-    def __init__(self, fpath: Path):
+    def __init__(self, fpath: Path, cover_size: tuple[int, int] | None = None):
         self.fpath = fpath
+        self.cover_size = cover_size
         self._metadata_file = MetadataSidecarFile(fpath)
         self._cover_file = CoverSidecarFile(fpath)
+        if cover_size:
+            (self._cover_file.cover_width, self._cover_file.cover_height) = cover_size
 
     def get_metadata(self) -> MetadataSidecarFile:
         return self._metadata_file
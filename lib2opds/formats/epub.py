@@ -4,19 +4,41 @@ import re
 import xml.etree.ElementTree as ET  # nosec B405 because actually defusedxml is used
 import zipfile
 from pathlib import Path
-from typing import Any
+from typing import IO, Any
 from urllib.parse import quote, urljoin
 
-from defusedxml.ElementTree import fromstring
+from defusedxml.ElementTree import fromstring, iterparse
 from PIL import Image
 
 from lib2opds.formats import EbookFile
 
 
+class ReadCountingFile(io.FileIO):
+    """File that counts the bytes read from it"""
+
+    bytes_read: int = 0
+
+    def read(self, size: int | None = -1) -> bytes:
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+
 class EpubFile(EbookFile):
     mimetype: str = "application/epub+zip"
 
     def read(self) -> bool:
+        try:
+            with ReadCountingFile(self.fpath) as f:
+                try:
+                    with zipfile.ZipFile(f) as zip:
+                        return self._read_zip(zip)
+                finally:
+                    self.bytes_read = f.bytes_read
+        except (OSError, zipfile.BadZipFile, ET.ParseError, ValueError):
+            return False
+
+    def _read_zip(self, zip: zipfile.ZipFile) -> bool:
         namespaces: dict[str, str] = {
             "cont": "urn:oasis:names:tc:opendocument:xmlns:container",
             "dc": "http://purl.org/dc/elements/1.1/",
@@ -24,15 +46,13 @@ class EpubFile(EbookFile):
             "pkg": "http://www.idpf.org/2007/opf",
         }
 
-        zip: zipfile.ZipFile = zipfile.ZipFile(self.fpath)
+        # Central directory is read only once
+        names: set[str] = set(zip.namelist())
         mimetype_filename: str = "mimetype"
         container_filename: str = "META-INF/container.xml"
 
         # Perform some checks to be sure that we deal with EPUB format
-        if (
-            container_filename not in zip.namelist()
-            or mimetype_filename not in zip.namelist()
-        ):
+        if container_filename not in names or mimetype_filename not in names:
             return False
 
         internal_mimetype: bytes = zip.read(mimetype_filename)
@@ -46,19 +66,18 @@ class EpubFile(EbookFile):
             "cont:rootfiles/cont:rootfile", namespaces=namespaces
         )
 
-        if rootfile_el is not None:
-            root_filename: str = rootfile_el.attrib["full-path"]
-        else:
+        if rootfile_el is None:
             return False
 
-        # Get root file
-        root_data: bytes = zip.read(root_filename)
-        root_xml: ET.Element = fromstring(root_data)
+        root_filename: str | None = rootfile_el.attrib.get("full-path")
+        if root_filename is None or root_filename not in names:
+            return False
+
+        # Get metadata and manifest of the root file, the spine and the rest
+        # of the file are never parsed
+        with zip.open(root_filename) as root_file:
+            (metadata_xml, manifest_xml) = self._read_package(root_file)
 
-        # Get metadata and update pub
-        metadata_xml: ET.Element | None = root_xml.find(
-            "pkg:metadata", namespaces=namespaces
-        )
         metadata_fields: dict[str, str] = {
             "title": "title",
             "language": "language",
@@ -86,9 +105,6 @@ class EpubFile(EbookFile):
                 self._metadata_file.authors.append(c.text)
 
         # Get cover
-        manifest_xml: ET.Element | None = root_xml.find(
-            "pkg:manifest", namespaces=namespaces
-        )
         if manifest_xml is not None:
             manifest_cover_el: ET.Element | None = metadata_xml.find(
                 'pkg:meta/[@name="cover"]', namespaces=namespaces
@@ -102,7 +118,7 @@ class EpubFile(EbookFile):
         cover_path: str | None = None
 
         if manifest_cover_el is not None:
-            cover_id: str = manifest_cover_el.attrib["content"]
+            cover_id: str = manifest_cover_el.attrib.get("content", "")
             valid: re.Pattern = re.compile(r"^[a-zA-Z._-]+$")
 
             if valid.match(cover_id):
@@ -110,27 +126,40 @@ class EpubFile(EbookFile):
                     f'pkg:item[@id="{cover_id}"]', namespaces=namespaces
                 )
 
-                if manifest_cover_path is not None:
-                    cover_path = str(
-                        Path(root_filename).parent
-                        / Path(manifest_cover_path.attrib["href"])
-                    )
+                if manifest_cover_path is not None and (
+                    cover_href := manifest_cover_path.attrib.get("href")
+                ):
+                    cover_path = str(Path(root_filename).parent / Path(cover_href))
 
-        if cover_path and cover_path in zip.namelist():
+        if cover_path and cover_path in names:
             cover_data: bytes = zip.read(cover_path)
-            try:
-                im: Image.Image = Image.open(io.BytesIO(cover_data))
-                if im.mode != "RGB":
-                    im = im.convert("RGB")
-                self._cover_file.cover = im
-                self._cover_file.cover_mimetype = "image/jpeg"
-            except OSError:
-                print(f"Can't convert cover for {self.fpath}")
-
-        zip.close()
+            self._cover_file.read_bytes(cover_data)
 
         return True
 
+    def _read_package(
+        self, root_file: IO[bytes]
+    ) -> tuple[ET.Element | None, ET.Element | None]:
+        """Parse the package document until its metadata and manifest are read"""
+        package_ns = "{http://www.idpf.org/2007/opf}"
+        metadata_xml: ET.Element | None = None
+        manifest_xml: ET.Element | None = None
+        depth = 0
+        for event, el in iterparse(root_file, events=("start", "end")):
+            if event == "start":
+                depth += 1
+                continue
+            depth -= 1
+            if depth != 1:
+                continue
+            if el.tag == package_ns + "metadata":
+                metadata_xml = el
+            elif el.tag == package_ns + "manifest":
+                manifest_xml = el
+            if metadata_xml is not None and manifest_xml is not None:
+                break
+        return (metadata_xml, manifest_xml)
+
     def _update_metadata(self, field_name: str, value: Any) -> None:
         if hasattr(self._metadata_file, field_name):
             setattr(self._metadata_file, field_name, value)
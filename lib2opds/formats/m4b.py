@@ -29,13 +29,6 @@ class M4bFile(EbookFile):
         if cprt := meta.get("cprt", None):
             self._metadata_file.publisher = cprt[0]
         if (cover_data := meta.get("covr", None)) and not self._cover_file.cover:
-            try:
-                im: Image.Image = Image.open(io.BytesIO(cover_data[0]))
-                if im.mode != "RGB":
-                    im = im.convert("RGB")
-                self._cover_file.cover = im
-                self._cover_file.cover_mimetype = "image/jpeg"
-            except:
-                print(f"Can't convert cover for {self.fpath}")
+            if not self._cover_file.read_bytes(bytes(cover_data[0])):
                 return False
         return True
@@ -2,22 +2,33 @@ import io
 import mimetypes
 import re
 from pathlib import Path
-from typing import Any
+from typing import Any, BinaryIO, cast
 from urllib.parse import quote, urljoin
 
 import pypdf
 from PIL import Image
+from pypdf.generic import ArrayObject, DictionaryObject, StreamObject
 
 from lib2opds.formats import EbookFile
 
+MAX_PAGE_TREE_DEPTH = 32
+
 
 class PdfFile(EbookFile):
     mimetype: str = "application/pdf"
     metadata_quality_score: int = -1
 
     def read(self) -> bool:
+        # Reader keeps reading from the open file instead of loading all of it
         try:
-            reader: pypdf.PdfReader = pypdf.PdfReader(self.fpath)
+            with self.fpath.open("rb") as f:
+                return self._read_pdf(f)
+        except OSError:
+            return False
+
+    def _read_pdf(self, f: BinaryIO) -> bool:
+        try:
+            reader: pypdf.PdfReader = pypdf.PdfReader(f)
             meta: pypdf.DocumentInformation | None = reader.metadata
         except:
             return False
@@ -32,20 +43,72 @@ class PdfFile(EbookFile):
             return True
 
         try:
-            page: pypdf.PageObject = reader.pages[0]
-            images: list[pypdf._utils.ImageFile] = page.images
+            cover = self._get_cover_image(reader)
         except:
             print(f"Can't convert cover for {self.fpath}")
             return False
 
-        if len(images) > 0:
-            try:
-                im: Image.Image = Image.open(io.BytesIO(images[0].data))
-                if im.mode != "RGB":
-                    im = im.convert("RGB")
-                self._cover_file.cover = im
-                self._cover_file.cover_mimetype = "image/jpeg"
-            except:
-                print(f"Can't convert cover for {self.fpath}")
+        if cover is not None:
+            (name, xobject) = cover
+            if xobject.get("/Filter") in ("/DCTDecode", ["/DCTDecode"]):
+                # JPEG stream is passed as it is without decoding it
+                data: bytes | None = xobject.get_data()
+            else:
+                try:
+                    data = self._get_page_image_data(reader, name)
+                except:
+                    print(f"Can't convert cover for {self.fpath}")
+                    return False
+            if data is not None and not self._cover_file.read_bytes(data):
                 return False
         return True
+
+    def _get_cover_image(
+        self, reader: pypdf.PdfReader
+    ) -> tuple[str, StreamObject] | None:
+        """Find the largest image of the first page by its declared size
+
+        Only the page tree nodes leading to the first page are resolved.
+        """
+        root = cast(DictionaryObject, reader.trailer["/Root"].get_object())
+        node = cast(DictionaryObject, root["/Pages"].get_object())
+        # Resources are inherited from the parent nodes
+        resources: Any = None
+        for _ in range(MAX_PAGE_TREE_DEPTH):
+            if "/Resources" in node:
+                resources = node["/Resources"]
+            if node.get("/Type") == "/Page" or "/Kids" not in node:
+                break
+            kids = cast(ArrayObject, node["/Kids"].get_object())
+            if not kids:
+                return None
+            node = cast(DictionaryObject, kids[0].get_object())
+        else:
+            return None
+
+        if resources is None:
+            return None
+        xobjects = resources.get_object().get("/XObject")
+        if xobjects is None:
+            return None
+
+        result: tuple[str, StreamObject] | None = None
+        result_area = -1
+        for name, xobject in xobjects.get_object().items():
+            xobject = xobject.get_object()
+            if not isinstance(xobject, StreamObject):
+                continue
+            if xobject.get("/Subtype") != "/Image":
+                continue
+            area = int(xobject.get("/Width", 0)) * int(xobject.get("/Height", 0))
+            if area > result_area:
+                result = (name, xobject)
+                result_area = area
+        return result
+
+    def _get_page_image_data(self, reader: pypdf.PdfReader, name: str) -> bytes | None:
+        # Only the chosen image is decoded, never the other images of the page
+        try:
+            return reader.pages[0].images[name].data
+        except (KeyError, TypeError):
+            return None
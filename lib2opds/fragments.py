@@ -0,0 +1,148 @@
+import hashlib
+import json
+import sqlite3
+from pathlib import Path
+from typing import Iterable
+
+from lib2opds.publications import Publication
+
+FRAGMENT_CACHE_FILENAME = "fragments.sqlite"
+FRAGMENT_CACHE_BATCH_SIZE = 256
+
+
+class FragmentCache:
+    """Rendered feed entries of publications
+
+    A publication is listed in several feeds, so its entries are rendered
+    once per run and kept in memory. With fpath set, they are stored in an
+    SQLite database keyed by a digest of the publication and the version of
+    the entry templates, so unchanged books are not rendered again in later
+    runs.
+    """
+
+    fpath: Path | None
+    version: str
+    connection: sqlite3.Connection | None
+    _entries: dict[tuple[str, str], str]
+    _digests: dict[str, str]
+    _pending: list[tuple[str, str, str]]
+    _disabled: bool
+
+    def __init__(self, fpath: Path | None = None, version: str = ""):
+        self.fpath = fpath
+        self.version = version
+        self.connection = None
+        self._entries = {}
+        self._digests = {}
+        self._pending = []
+        self._disabled = False
+
+    def open(self) -> bool:
+        if self.connection is not None:
+            return True
+        if self.fpath is None or self._disabled:
+            return False
+        try:
+            self.connection = sqlite3.connect(
+                self.fpath, timeout=60, isolation_level=None
+            )
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries (digest TEXT NOT NULL,"
+                " kind TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (digest, kind))"
+            )
+        except sqlite3.Error as e:
+            print(f"Can't open cache {self.fpath}: {e}")
+            self._disabled = True
+            self.connection = None
+            return False
+        return True
+
+    def close(self, publications: Iterable[Publication] | None = None) -> None:
+        """Store new entries and remove entries of other publications
+
+        Without publications, stored entries are kept as they are.
+        """
+        if publications is not None:
+            self.open()
+        if self.connection is None:
+            return
+        try:
+            self.flush()
+            if publications is not None:
+                self._prune(set(self.get_digest(p) for p in publications))
+        finally:
+            self.connection.close()
+            self.connection = None
+
+    def flush(self) -> None:
+        if self.connection is None or not self._pending:
+            return
+        try:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO entries (digest, kind, data) VALUES (?, ?, ?)",
+                self._pending,
+            )
+            self.connection.execute("COMMIT")
+        except sqlite3.Error as e:
+            print(f"Can't write cache {self.fpath}: {e}")
+            if self.connection.in_transaction:
+                self.connection.execute("ROLLBACK")
+        finally:
+            self._pending.clear()
+
+    def get_digest(self, p: Publication) -> str:
+        if (digest := self._digests.get(p._id)) is None:
+            data = json.dumps([self.version, p.to_dict()], sort_keys=True).encode()
+            digest = hashlib.sha256(data).hexdigest()
+            self._digests[p._id] = digest
+        return digest
+
+    def get_entry(self, p: Publication, kind: str) -> str | None:
+        if (entry := self._entries.get((p._id, kind))) is not None:
+            return entry
+        if not self.open() or self.connection is None:
+            return None
+        row = self.connection.execute(
+            "SELECT data FROM entries WHERE digest = ? AND kind = ?",
+            (self.get_digest(p), kind),
+        ).fetchone()
+        if row is None:
+            return None
+        entry = str(row[0])
+        self._entries[(p._id, kind)] = entry
+        return entry
+
+    def set_entry(self, p: Publication, kind: str, entry: str) -> None:
+        self._entries[(p._id, kind)] = entry
+        if not self.open():
+            return
+        self._pending.append((self.get_digest(p), kind, entry))
+        if len(self._pending) >= FRAGMENT_CACHE_BATCH_SIZE:
+            self.flush()
+
+    def _prune(self, digests: set[str]) -> None:
+        if self.connection is None:
+            return
+        connection = self.connection
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS used_digests (digest TEXT PRIMARY KEY)"
+            )
+            connection.execute("DELETE FROM used_digests")
+            connection.executemany(
+                "INSERT OR IGNORE INTO used_digests (digest) VALUES (?)",
+                ((digest,) for digest in digests),
+            )
+            connection.execute(
+                "DELETE FROM entries"
+                " WHERE digest NOT IN (SELECT digest FROM used_digests)"
+            )
+            connection.execute("COMMIT")
+        except sqlite3.Error as e:
+            print(f"Can't prune cache {self.fpath}: {e}")
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
@@ -0,0 +1,338 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any
+
+from lib2opds import __version__
+from lib2opds.config import Config
+from lib2opds.feeds import AcquisitionFeed, AtomFeed, NavigationFeed
+from lib2opds.publications import Publication
+from lib2opds.scanner import (
+    DirectoryState,
+    FileStat,
+    ScannedDirectory,
+    get_file_stat,
+    is_dir_changed,
+)
+
+MANIFEST_VERSION = 1
+
+
+def get_file_group_signature(
+    files: list[Path], stats: dict[Path, FileStat] | None = None
+) -> list[list[Any]]:
+    result: list[list[Any]] = []
+    for f in sorted(files):
+        st = get_file_stat(f, stats)
+        result.append([f.name, st.size, st.mtime_ns, st.inode])
+    return result
+
+
+def get_manifest_settings(config: Config) -> dict[str, Any]:
+    # Changing any of these invalidates every stored publication
+    return {
+        "library_dir": str(config.library_dir),
+        "library_base_uri": config.library_base_uri,
+        "opds_dir": str(config.opds_dir),
+        "opds_base_uri": config.opds_base_uri,
+        "cover_width": config.cover_width,
+        "cover_height": config.cover_height,
+        "cover_quality": config.cover_quality,
+        "sidecar_fallback_fields": config.sidecar_fallback_fields,
+        "ebook_cover_fallback": config.ebook_cover_fallback,
+        "shard_depth": config.shard_depth,
+    }
+
+
+def write_json(fpath: Path, data: Any) -> bool:
+    tmp_fpath = fpath.with_name(fpath.name + ".tmp")
+    try:
+        with tmp_fpath.open("w") as f:
+            json.dump(data, f)
+        os.replace(tmp_fpath, fpath)
+    except OSError:
+        return False
+    return True
+
+
+def read_json(fpath: Path) -> Any:
+    try:
+        with fpath.open() as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class BuildManifest:
+    """Publications extracted by the previous run keyed by file group"""
+
+    fpath: Path
+    settings: dict[str, Any]
+    _previous: dict[str, dict[str, Any]]
+    _current: dict[str, dict[str, Any]]
+
+    def __init__(self, fpath: Path, config: Config):
+        self.fpath = fpath
+        self.settings = get_manifest_settings(config)
+        self._previous = {}
+        self._current = {}
+
+    def load(self) -> bool:
+        data = read_json(self.fpath)
+        if not isinstance(data, dict):
+            return False
+        if data.get("version") != MANIFEST_VERSION:
+            return False
+        if data.get("settings") != self.settings:
+            return False
+        self._previous = data.get("groups", {})
+        return True
+
+    def save(self) -> bool:
+        data = {
+            "version": MANIFEST_VERSION,
+            "settings": self.settings,
+            "groups": self._current,
+        }
+        return write_json(self.fpath, data)
+
+    def get_publication(self, key: str, signature: list[list[Any]]) -> Publication | None:
+        entry = self._previous.get(key)
+        if entry is None or entry["signature"] != signature:
+            return None
+        try:
+            return Publication.from_dict(entry["publication"])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def get_cache_keys(self, key: str) -> list[str] | None:
+        """Metadata cache keys of the file group stored by the previous run"""
+        entry = self._previous.get(key)
+        if entry is None or not isinstance(entry.get("cache_keys"), list):
+            return None
+        return [str(cache_key) for cache_key in entry["cache_keys"]]
+
+    def add_publication(
+        self,
+        key: str,
+        signature: list[list[Any]],
+        p: Publication,
+        cache_keys: list[str] | None = None,
+    ) -> None:
+        self._current[key] = {
+            "signature": signature,
+            "publication": p.to_dict(),
+            "cache_keys": cache_keys if cache_keys else [],
+        }
+
+
+class DirectoryManifest:
+    """States of library directories seen by the previous run"""
+
+    fpath: Path
+    config: Config
+    states: dict[Path, DirectoryState]
+    stats: dict[Path, FileStat]
+    _current: dict[str, dict[str, Any]]
+
+    def __init__(self, fpath: Path, config: Config):
+        self.fpath = fpath
+        self.config = config
+        self.states = {}
+        self.stats = {}
+        self._current = {}
+
+    def load(self) -> bool:
+        data = read_json(self.fpath)
+        if not isinstance(data, dict):
+            return False
+        if data.get("version") != MANIFEST_VERSION:
+            return False
+        if data.get("library_dir") != str(self.config.library_dir):
+            return False
+        try:
+            for path, state in data.get("directories", {}).items():
+                self.states[self.config.library_dir / path] = DirectoryState(
+                    state["mtime_ns"],
+                    state["digest"],
+                    state["dirs"],
+                    {name: FileStat(*stat) for name, stat in state["files"].items()},
+                )
+        except (KeyError, TypeError):
+            self.states = {}
+            return False
+        return True
+
+    def save(self) -> bool:
+        data = {
+            "version": MANIFEST_VERSION,
+            "library_dir": str(self.config.library_dir),
+            "directories": self._current,
+        }
+        return write_json(self.fpath, data)
+
+    def update(self, directory: ScannedDirectory) -> None:
+        state = directory.get_state()
+        self._current[str(directory.path.relative_to(self.config.library_dir))] = {
+            "mtime_ns": state.mtime_ns,
+            "digest": state.digest,
+            "dirs": state.dirs,
+            "files": {
+                name: [stat.size, stat.mtime_ns, stat.inode]
+                for name, stat in state.files.items()
+            },
+        }
+        for d in directory.dirs:
+            self.update(d)
+
+    def is_library_changed(self) -> bool:
+        return is_dir_changed(
+            self.config.library_dir,
+            self.states,
+            self.config.check_file_changes,
+            self.stats,
+        )
+
+
+def get_feed_manifest_settings(config: Config) -> dict[str, Any]:
+    # Changing any of these invalidates every rendered feed
+    return {
+        "version": __version__,
+        "opds_dir": str(config.opds_dir),
+        "opds_base_uri": config.opds_base_uri,
+        "library_title": config.library_title,
+        "root_filename": config.root_filename,
+        "index_filename": config.index_filename,
+        "feeds_dir": str(config.feeds_dir),
+        "pages_dir": str(config.pages_dir),
+        "assets_dir": str(config.assets_dir),
+        "generate_site_xslt": config.generate_site_xslt,
+        "shard_depth": config.shard_depth,
+        "page_size": config.page_size,
+    }
+
+
+class FeedManifest:
+    """Digests of feeds rendered by the previous run keyed by feed ID"""
+
+    fpath: Path
+    config: Config
+    settings: dict[str, Any]
+    _previous: dict[str, dict[str, Any]]
+    _current: dict[str, dict[str, Any]]
+    _publication_digests: dict[str, str]
+
+    def __init__(self, fpath: Path, config: Config):
+        self.fpath = fpath
+        self.config = config
+        self.settings = get_feed_manifest_settings(config)
+        self._previous = {}
+        self._current = {}
+        self._publication_digests = {}
+
+    def load(self) -> bool:
+        data = read_json(self.fpath)
+        if not isinstance(data, dict):
+            return False
+        if data.get("version") != MANIFEST_VERSION:
+            return False
+        self._previous = data.get("feeds", {})
+        if data.get("settings") != self.settings:
+            # Keep only paths, so files of pages which are gone get removed
+            self._previous = {
+                feed_id: {"paths": entry.get("paths", [])}
+                for feed_id, entry in self._previous.items()
+            }
+            return False
+        return True
+
+    def save(self) -> bool:
+        data = {
+            "version": MANIFEST_VERSION,
+            "settings": self.settings,
+            "feeds": self._current,
+        }
+        return write_json(self.fpath, data)
+
+    def update(self, feed: AtomFeed) -> None:
+        """Mark unchanged feeds so that export skips them
+
+        Children are processed first, so the digest of a parent covers
+        the digests and updated timestamps of its entries.
+        """
+        if isinstance(feed, NavigationFeed):
+            for entry in feed.entries:
+                self.update(entry)
+
+        digest = self._get_feed_digest(feed)
+        previous = self._previous.get(feed.id)
+        if previous is not None and previous.get("digest") == digest:
+            feed.updated = previous["updated"]
+            feed.changed = False
+        else:
+            feed.changed = True
+
+        self._current[feed.id] = {
+            "digest": digest,
+            "updated": feed.updated,
+            "paths": [
+                str(local_path.relative_to(self.config.get_output_dir()))
+                for local_path in feed.get_local_paths()
+            ],
+        }
+
+    def remove_stale_feeds(self) -> list[Path]:
+        """Remove files of feeds and pages which are not in the catalog anymore"""
+        result: list[Path] = []
+        current_paths = {
+            path for entry in self._current.values() for path in entry["paths"]
+        }
+        for entry in self._previous.values():
+            for path in entry["paths"]:
+                if path in current_paths:
+                    continue
+                local_path = self.config.get_output_dir() / path
+                if local_path.is_file():
+                    local_path.unlink()
+                    result.append(local_path)
+        return result
+
+    def _get_publication_digest(self, p: Publication) -> str:
+        if (digest := self._publication_digests.get(p._id)) is None:
+            data = json.dumps(p.to_dict(), sort_keys=True).encode()
+            digest = hashlib.sha256(data).hexdigest()
+            self._publication_digests[p._id] = digest
+        return digest
+
+    def _get_feed_digest(self, feed: AtomFeed) -> str:
+        state: list[Any] = [
+            type(feed).__name__,
+            feed.get_title(),
+            feed.parent.id if feed.parent else "",
+        ]
+        # Feeds are sorted by title before rendering, so the order does not
+        # matter here
+        if isinstance(feed, AcquisitionFeed):
+            state.append(
+                sorted(self._get_publication_digest(p) for p in feed.publications)
+            )
+        elif isinstance(feed, NavigationFeed):
+            entries: list[list[Any]] = []
+            for entry in feed.entries:
+                count = (
+                    len(entry.publications) if isinstance(entry, AcquisitionFeed) else 0
+                )
+                entries.append(
+                    [
+                        entry.id,
+                        self._current[entry.id]["digest"],
+                        type(entry).__name__,
+                        entry.get_title(),
+                        entry.updated,
+                        count,
+                    ]
+                )
+            state.append(entries if feed.is_root() else sorted(entries))
+        data = json.dumps(state).encode()
+        return hashlib.sha256(data).hexdigest()
@@ -9,96 +9,47 @@ from urllib.parse import quote, urljoin
 
 from lib2opds.config import Config
 from lib2opds.feeds import AcquisitionFeed, AtomFeed, NavigationFeed
+from lib2opds.manifests import BuildManifest, DirectoryManifest
+from lib2opds.outputs import OutputWriter
 from lib2opds.publications import Publication
-from lib2opds.repositories import CachingFilesystemRepository
-
-
-def get_dir_contents(dirpath: Path) -> tuple[list[str], list[str]]:
-    dirnames = []
-    filenames = []
-    with os.scandir(dirpath) as it:
-        for entry in it:
-            if entry.is_dir():
-                dirnames.append(entry.path)
-            elif entry.is_file():
-                filenames.append(entry.path)
-    return (dirnames, filenames)
-
-
-def get_titles_from_publications(publications: list[Publication]) -> set[str]:
-    result: set[str] = set()
-    for p in publications:
-        result.add(p.title)
-    return result
-
-
-def get_authors_from_publications(publications: list[Publication]) -> set[str]:
-    result: set[str] = set()
-    for p in publications:
-        for author in p.authors:
-            result.add(author)
-    return result
-
-
-def get_languages_from_publications(publications: list[Publication]) -> set[str]:
-    result: set[str] = set()
-    for p in publications:
-        if p.language:
-            result.add(p.language)
-    return result
-
-
-def get_index_by_filename(files: list[list[Path]], filename: Path) -> int:
-    for i in range(len(files)):
-        for f in files[i]:
-            if f.stem == filename.stem:
-                return i
-    return -1
-
-
-def group_files_by_filename(filenames: list[str]) -> list[list[Path]]:
-    result: list[list[Path]] = []
-
-    for f in filenames:
-        tmp = Path(f)
-        if (i := get_index_by_filename(result, tmp)) >= 0:
-            result[i].append(tmp)
-        else:
-            result.append([tmp])
-
-    return result
+from lib2opds.repositories import (
+    CachingFilesystemRepository,
+    FilesystemRepository,
+    IncrementalFilesystemRepository,
+)
+from lib2opds.scanner import ScannedDirectory, scan_dir
 
 
 def dir2odps(
-    config: Config, dirpath: Path, parent: AtomFeed, root: AtomFeed
+    config: Config,
+    directory: ScannedDirectory,
+    parent: AtomFeed,
+    root: AtomFeed,
+    repo: FilesystemRepository | None = None,
 ) -> NavigationFeed | AcquisitionFeed:
-    dirnames: list[str]
-    filenames: list[str]
-    dirnames, filenames = get_dir_contents(dirpath)
-    last_updated = datetime.fromtimestamp(dirpath.stat().st_mtime)
-    title = dirpath.name.capitalize()
+    title = directory.path.name.capitalize()
+    key = "directory:" + str(directory.path.relative_to(config.library_dir))
 
-    repo = CachingFilesystemRepository(config)
+    if repo is None:
+        repo = CachingFilesystemRepository(config)
     # Directory contains other directories or empty
-    if len(dirnames) > 0 or (len(dirnames) + len(filenames) == 0):
-        feed = NavigationFeed(config, root, parent, title)
-        for d in dirnames:
+    if len(directory.dirs) > 0 or directory.is_empty():
+        feed = NavigationFeed(config, root, parent, title, key=key)
+        for d in directory.dirs:
             dir_feed: NavigationFeed | AcquisitionFeed = dir2odps(
-                config, Path(d), feed, root
+                config, d, feed, root, repo
             )
             feed.entries.append(dir_feed)
         return feed
-    elif len(filenames) > 0:
-        feed = AcquisitionFeed(config, root, parent, title)
+    elif len(directory.file_groups) > 0:
+        feed = AcquisitionFeed(config, root, parent, title, key=key)
 
-        files = group_files_by_filename(filenames)
-
-        for f in files:
-            if p := repo.get_publication(f):
+        for group in directory.file_groups:
+            if p := repo.get_publication(group.files, group.stats):
                 feed.publications.append(p)
         return feed
     else:
-        raise Exception("Mixed dir {}".format(dirpath))
+        raise Exception("Mixed dir {}".format(directory.path))
 
 
 def author_to_first_letters(author: str) -> set[str]:
@@ -120,184 +71,221 @@ def generate_first_letters(strings: set[str], split: bool = True) -> set[str]:
     return result
 
 
-def is_feed_sutable_to_author(feed: AtomFeed, author: str) -> bool:
-    letters = author_to_first_letters(author)
-    if feed.title.upper() in letters:
-        return True
-    else:
-        return False
+def convert_issued_to_datetime(issued: str) -> datetime:
+    try:
+        return datetime.fromisoformat(issued)
+    except ValueError:
+        pass
+
+    try:
+        return datetime.strptime(issued, "%Y")
+    except ValueError:
+        pass
 
+    raise ValueError
 
-def get_feed_all_publications(
-    config: Config, feed_root: NavigationFeed, all_publications: list[Publication]
-) -> AcquisitionFeed:
-    feed_all_publications = AcquisitionFeed(
-        config, feed_root, feed_root, config.feed_all_publications_title
-    )
-    for p in all_publications:
-        feed_all_publications.publications.append(p)
-    return feed_all_publications
+
+def convert_issued_to_decade(issued: str) -> str:
+    try:
+        issued_date = convert_issued_to_datetime(issued)
+    except ValueError:
+        return "Unknow"
+    return str(issued_date.year // 10 * 10) + "s"
+
+
+@dataclass
+class PublicationIndex:
+    """Virtual shelves of the library built in one pass over all publications"""
+
+    publications: list[Publication] = field(default_factory=list)
+    by_author: dict[str, list[Publication]] = field(default_factory=dict)
+    by_title_letter: dict[str, list[Publication]] = field(default_factory=dict)
+    by_language: dict[str, list[Publication]] = field(default_factory=dict)
+    by_issued_decade: dict[str, list[Publication]] = field(default_factory=dict)
+    new_publications: list[Publication] = field(default_factory=list)
+    author_letters: set[str] = field(default_factory=set)
+    title_letters: set[str] = field(default_factory=set)
+    issued_decades: set[str] = field(default_factory=set)
+
+    @classmethod
+    def from_publications(cls, config: Config, publications: list[Publication]) -> Self:
+        result = cls(publications)
+        now = datetime.now()
+
+        for p in publications:
+            for author in dict.fromkeys(p.authors):
+                result.by_author.setdefault(author, []).append(p)
+            if p.title:
+                result.by_title_letter.setdefault(p.title[0], []).append(p)
+            if p.language:
+                result.by_language.setdefault(p.language, []).append(p)
+            decade = convert_issued_to_decade(p.issued)
+            result.by_issued_decade.setdefault(decade, []).append(p)
+            if p.issued:
+                result.issued_decades.add(decade)
+            if (now - p.updated).days < config.publication_freshness_days:
+                result.new_publications.append(p)
+
+        result.author_letters = generate_first_letters(set(result.by_author))
+        result.title_letters = generate_first_letters(
+            set(p.title for p in publications), False
+        )
+        return result
 
 
 def get_feed_by_author(
-    config: Config, feed_root: NavigationFeed, all_publications: list[Publication]
+    config: Config, feed_root: NavigationFeed, index: PublicationIndex
 ) -> NavigationFeed:
-    all_authors: set[str] = get_authors_from_publications(all_publications)
     result: NavigationFeed = NavigationFeed(
-        config, feed_root, feed_root, config.feed_by_author_title
+        config, feed_root, feed_root, config.feed_by_author_title, key="authors"
     )
 
-    # A, B, C ... Z
-    first_letters: set[str] = generate_first_letters(all_authors)
-
     # feed_by_author -> [A, B, C ... Z]
-    for first_letter in first_letters:
+    letter_feeds: dict[str, NavigationFeed] = {}
+    for first_letter in index.author_letters:
         feed_by_author_first_letter: NavigationFeed = NavigationFeed(
-            config, feed_root, result, first_letter
+            config, feed_root, result, first_letter, key="authors:" + first_letter
         )
+        letter_feeds[first_letter] = feed_by_author_first_letter
         result.entries.append(feed_by_author_first_letter)
     # A -> [Author1, Author2], B -> ...
-    for author in all_authors:
-        for feed in result.entries:
-            if not is_feed_sutable_to_author(feed, author):
+    for author, author_publications_list in index.by_author.items():
+        for letter in author_to_first_letters(author):
+            if (feed := letter_feeds.get(letter)) is None:
                 continue
             author_publications: AcquisitionFeed = AcquisitionFeed(
-                config, feed_root, feed, author
+                config, feed_root, feed, author, key=feed.key + ":" + author
             )
-            for p in all_publications:
-                if author in p.authors:
-                    author_publications.publications.append(p)
-            if isinstance(feed, NavigationFeed):
-                feed.entries.append(author_publications)
+            author_publications.publications.extend(author_publications_list)
+            feed.entries.append(author_publications)
     return result
 
 
 def get_feed_all_publications_index(
-    config: Config, feed_root: NavigationFeed, all_publications: list[Publication]
+    config: Config, feed_root: NavigationFeed, index: PublicationIndex
 ) -> NavigationFeed:
-    all_titles: set[str] = get_titles_from_publications(all_publications)
     result: NavigationFeed = NavigationFeed(
-        config, feed_root, feed_root, config.feed_all_publications_title
+        config, feed_root, feed_root, config.feed_all_publications_title, key="all"
     )
 
-    first_letters: set[str] = generate_first_letters(all_titles, False)
-
-    for first_letter in first_letters:
+    for first_letter in index.title_letters:
         feed_by_title_first_letter: AcquisitionFeed = AcquisitionFeed(
-            config, feed_root, result, first_letter
+            config, feed_root, result, first_letter, key="all:" + first_letter
+        )
+        feed_by_title_first_letter.publications.extend(
+            index.by_title_letter.get(first_letter, [])
         )
-        for p in all_publications:
-            if p.title.startswith(first_letter):
-                feed_by_title_first_letter.publications.append(p)
         result.entries.append(feed_by_title_first_letter)
     return result
 
 
 def get_feed_by_language(
-    config: Config, feed_root: NavigationFeed, all_publications: list[Publication]
+    config: Config, feed_root: NavigationFeed, index: PublicationIndex
 ) -> NavigationFeed:
-    all_languages: set[str] = get_languages_from_publications(all_publications)
     result: NavigationFeed = NavigationFeed(
-        config, feed_root, feed_root, config.feed_by_language_title
+        config, feed_root, feed_root, config.feed_by_language_title, key="languages"
     )
-    for language in all_languages:
+    for language, publications in index.by_language.items():
         language_publications: AcquisitionFeed = AcquisitionFeed(
-            config, feed_root, result, language
+            config, feed_root, result, language, key="languages:" + language
         )
-        for p in all_publications:
-            if language == p.language:
-                language_publications.publications.append(p)
+        language_publications.publications.extend(publications)
         result.entries.append(language_publications)
 
     return result
 
 
-def convert_issued_to_datetime(issued: str) -> datetime:
-    try:
-        return datetime.fromisoformat(issued)
-    except ValueError:
-        pass
-
-    try:
-        return datetime.strptime(issued, "%Y")
-    except ValueError:
-        pass
-
-    raise ValueError
-
-
-def convert_issued_to_decade(issued: str) -> str:
-    try:
-        issued_date = convert_issued_to_datetime(issued)
-    except ValueError:
-        return "Unknow"
-    return str(issued_date.year // 10 * 10) + "s"
-
-
-def get_issued_decades_from_publications(publications: list[Publication]) -> set[str]:
-    result: set[str] = set()
-    for p in publications:
-        if p.issued:
-            result.add(convert_issued_to_decade(p.issued))
-    return result
-
-
 def get_feed_by_issued(
-    config: Config, feed_root: NavigationFeed, all_publications: list[Publication]
+    config: Config, feed_root: NavigationFeed, index: PublicationIndex
 ) -> NavigationFeed:
-    all_issued_decades: set[str] = get_issued_decades_from_publications(all_publications)
     result: NavigationFeed = NavigationFeed(
-        config, feed_root, feed_root, config.feed_by_issued_date_title
+        config, feed_root, feed_root, config.feed_by_issued_date_title, key="issued"
     )
-    for issued_decade in all_issued_decades:
+    for issued_decade in index.issued_decades:
         issued_publications: AcquisitionFeed = AcquisitionFeed(
-            config, feed_root, result, issued_decade
+            config, feed_root, result, issued_decade, key="issued:" + issued_decade
         )
-        for p in all_publications:
-            if issued_decade == convert_issued_to_decade(p.issued):
-                issued_publications.publications.append(p)
+        issued_publications.publications.extend(index.by_issued_decade[issued_decade])
         result.entries.append(issued_publications)
 
     return result
 
 
 def get_feed_new_publications(
-    config: Config, feed_root: NavigationFeed, all_publications: list[Publication]
+    config: Config, feed_root: NavigationFeed, index: PublicationIndex
 ) -> AcquisitionFeed:
     feed_new_publications = AcquisitionFeed(
-        config, feed_root, feed_root, config.feed_new_publications_title
+        config, feed_root, feed_root, config.feed_new_publications_title, key="new"
     )
-
-    for p in all_publications:
-        if (datetime.now() - p.updated).days < config.publication_freshness_days:
-            feed_new_publications.publications.append(p)
+    feed_new_publications.publications.extend(index.new_publications)
     return feed_new_publications
 
 
 def get_random_book_feed(
-    config: Config, feed_root: NavigationFeed, all_publications: list[Publication]
+    config: Config, feed_root: NavigationFeed, index: PublicationIndex
 ) -> AcquisitionFeed:
     result: AcquisitionFeed = AcquisitionFeed(
-        config, feed_root, feed_root, config.feed_random_book_title
+        config, feed_root, feed_root, config.feed_random_book_title, key="random"
     )
-    result.publications.append(secrets.choice(all_publications))
+    result.publications.append(secrets.choice(index.publications))
     return result
 
 
-def lib2odps(config: Config, dirpath: Path) -> AtomFeed:
+def lib2odps(
+    config: Config,
+    dirpath: Path,
+    directories: DirectoryManifest | None = None,
+    output: OutputWriter | None = None,
+) -> AtomFeed:
     title = config.library_title
-    feed_root = NavigationFeed(config, None, None, title)
+    feed_root = NavigationFeed(config, None, None, title, key="root")
+
+    manifest: BuildManifest | None = None
+    if manifest_path := config.get_manifest_path():
+        manifest = BuildManifest(manifest_path, config)
+        manifest.load()
+    repo = IncrementalFilesystemRepository(config, manifest, output)
+
+    library: ScannedDirectory = scan_dir(
+        config.library_dir,
+        states=directories.states if directories else None,
+        check_file_changes=config.check_file_changes,
+        stats=directories.stats if directories else None,
+    )
+    if directories:
+        directories.update(library)
+
+    if config.jobs > 1:
+        repo.prefetch_publications(library.get_all_file_groups(), config.jobs)
 
     # By directory
-    feed_by_directory = dir2odps(config, config.library_dir, feed_root, feed_root)
+    feed_by_directory = dir2odps(config, library, feed_root, feed_root, repo)
     feed_by_directory.title = config.feed_by_directory_title
     feed_root.entries.append(feed_by_directory)
 
     all_publications: list[Publication] = feed_by_directory.get_all_publications()
 
+    repo.prune_cache()
+    repo.close()
+    # Publications of an unmounted library are reused once it is back
+    if manifest and all_publications:
+        manifest.save()
+
+    if repo.failures:
+        print(f"Can't read {len(repo.failures)} ebook files:")
+        for fpath, reason in sorted(repo.failures.items()):
+            print(f"  {fpath}: {reason}")
+    if repo.known_failures:
+        print(
+            f"Skipped {len(repo.known_failures)} ebook files which couldn't be read"
+            " before, use --retry-failed to read them again"
+        )
+
+    index = PublicationIndex.from_publications(config, all_publications)
+
     # New
     feed_new_publications: AcquisitionFeed = get_feed_new_publications(
-        config, feed_root, all_publications
+        config, feed_root, index
     )
 
     if len(feed_new_publications.get_all_publications()):
@@ -305,35 +293,30 @@ def lib2odps(config: Config, dirpath: Path) -> AtomFeed:
 
     # All publications
     feed_all_publications: NavigationFeed = get_feed_all_publications_index(
-        config, feed_root, all_publications
+        config, feed_root, index
     )
     feed_root.entries.append(feed_all_publications)
 
     # By author
-    feed_by_author: NavigationFeed = get_feed_by_author(
-        config, feed_root, all_publications
-    )
+    feed_by_author: NavigationFeed = get_feed_by_author(config, feed_root, index)
     feed_root.entries.append(feed_by_author)
 
     # By language
     if config.generate_languages_feed:
-        feed_by_language: NavigationFeed = get_feed_by_language(
-            config, feed_root, all_publications
-        )
+        feed_by_language: NavigationFeed = get_feed_by_language(config, feed_root, index)
         feed_root.entries.append(feed_by_language)
 
     # By issued date
     if config.generate_issued_feed:
-        feed_by_issued: NavigationFeed = get_feed_by_issued(
-            config, feed_root, all_publications
-        )
+        feed_by_issued: NavigationFeed = get_feed_by_issued(config, feed_root, index)
         feed_root.entries.append(feed_by_issued)
 
     # Random book feed
     if config.generate_random_book_feed:
-        random_book_feed: AcquisitionFeed = get_random_book_feed(
-            config, feed_root, all_publications
-        )
+        random_book_feed: AcquisitionFeed = get_random_book_feed(config, feed_root, index)
         feed_root.entries.append(random_book_feed)
 
+    # Sorted once here, templates render entries in the order they have
+    feed_root.sort()
+
     return feed_root
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from lib2opds.publishers import encode_chunks, replace_file, write_temp_file
+
+
+def get_content_hash(data: str | bytes) -> str:
+    if isinstance(data, str):
+        data = data.encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+def write_hashed_temp_file(fpath: Path, chunks: Iterable[str]) -> tuple[Path, str]:
+    """Write chunks to a temporary file next to fpath while hashing them
+
+    Return the path of the temporary file and the content hash.
+    """
+    digest = hashlib.sha256()
+
+    def hash_chunks() -> Iterator[bytes]:
+        for chunk in encode_chunks(chunks):
+            digest.update(chunk)
+            yield chunk
+
+    tmp_fpath = write_temp_file(fpath, hash_chunks())
+    return (tmp_fpath, digest.hexdigest())
+
+
+class OutputWriter:
+    """Writes catalog files only if their content changed since the last run
+
+    Content hashes of written files are kept in a manifest, so unchanged
+    files keep their mtime. Paths are relative to the output directory.
+    """
+
+    root: Path
+    fpath: Path | None
+    changed: list[str]
+    removed: list[str]
+    _hashes: dict[str, str]
+    _previous: dict[str, str]
+    _rewritten: bool
+
+    def __init__(self, root: Path, fpath: Path | None = None):
+        self.root = root
+        self.fpath = fpath
+        self.changed = []
+        self.removed = []
+        self._hashes = {}
+        self._previous = {}
+        self._rewritten = False
+
+    def load(self, skip_unchanged: bool = True) -> bool:
+        """Load content hashes of the last run as the base of the changes
+
+        If skip_unchanged is false, the output directory was cleared, so all
+        files are written again and files not written are removed ones.
+        """
+        self._rewritten = not skip_unchanged
+        if self.fpath is None:
+            return False
+        try:
+            with self.fpath.open() as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if not isinstance(data, dict) or not isinstance(data.get("files"), dict):
+            return False
+        self._previous = data["files"]
+        if skip_unchanged:
+            self._hashes = dict(self._previous)
+        return True
+
+    def save(self) -> bool:
+        if self.fpath is None:
+            return False
+        return replace_file(self.fpath, json.dumps({"files": self._hashes}))
+
+    def write(self, fpath: Path, data: str | bytes | Iterable[str]) -> bool:
+        """Write data unless fpath already has the same content
+
+        A stream of chunks is written to a temporary file while its hash is
+        computed and the file is dropped if the content turns out unchanged.
+        """
+        if not isinstance(data, (str, bytes)):
+            return self._write_stream(fpath, data)
+        path = str(fpath.relative_to(self.root))
+        content_hash = get_content_hash(data)
+        if self._hashes.get(path) == content_hash and fpath.is_file():
+            return True
+        if not replace_file(fpath, data):
+            return False
+        self._record(path, content_hash)
+        return True
+
+    def _write_stream(self, fpath: Path, chunks: Iterable[str]) -> bool:
+        try:
+            (tmp_fpath, content_hash) = write_hashed_temp_file(fpath, chunks)
+        except OSError:
+            return False
+        return self.replace(fpath, tmp_fpath, content_hash)
+
+    def replace(self, fpath: Path, tmp_fpath: Path, content_hash: str) -> bool:
+        """Rename the temporary file to fpath unless it has the same content"""
+        path = str(fpath.relative_to(self.root))
+        try:
+            if self._hashes.get(path) == content_hash and fpath.is_file():
+                tmp_fpath.unlink()
+                return True
+            os.replace(tmp_fpath, fpath)
+        except OSError:
+            tmp_fpath.unlink(missing_ok=True)
+            return False
+        self._record(path, content_hash)
+        return True
+
+    def add(self, fpath: Path) -> None:
+        """Record a file written by other means, if it has changed"""
+        try:
+            content_hash = get_content_hash(fpath.read_bytes())
+        except OSError:
+            return
+        path = str(fpath.relative_to(self.root))
+        if self._hashes.get(path) != content_hash:
+            self._record(path, content_hash)
+
+    def _record(self, path: str, content_hash: str) -> None:
+        self._hashes[path] = content_hash
+        self.changed.append(path)
+
+    def remove(self, fpath: Path) -> None:
+        path = str(fpath.relative_to(self.root))
+        self._hashes.pop(path, None)
+        self.removed.append(path)
+
+    def get_changes(self) -> dict[str, dict[str, str | None]]:
+        """Old and new content hashes of changed paths
+
+        The old hash of an added file and the new hash of a removed file
+        are None. Files written again with the same content are left out.
+        """
+        result: dict[str, dict[str, str | None]] = {}
+        for path in self.changed:
+            old = self._previous.get(path)
+            if (new := self._hashes.get(path)) is not None and new != old:
+                result[path] = {"old": old, "new": new}
+        removed = list(self.removed)
+        if self._rewritten:
+            removed += [path for path in self._previous if path not in self._hashes]
+        for path in removed:
+            result[path] = {"old": self._previous.get(path), "new": None}
+        return result
+
+    def write_changed_paths(self, fpath: Path) -> bool:
+        """Write changed and removed paths one per line
+
+        The list suits rsync --files-from with --delete-missing-args.
+        """
+        paths = sorted(self.get_changes())
+        return replace_file(fpath, "".join(path + "\n" for path in paths))
@@ -41,5 +41,49 @@ class Publication:
     updated: datetime = field(default_factory=datetime.now)
 
     def __post_init__(self) -> None:
-        self._id = str(uuid.uuid4())
+        if not self._id:
+            self._id = str(uuid.uuid4())
         self.cover_filename = str(self._id) + ".jpg"
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "title": self.title,
+            "authors": self.authors,
+            "language": self.language,
+            "identifier": self.identifier,
+            "description": self.description,
+            "cover_href": self.cover_href,
+            "cover_mimetype": self.cover_mimetype,
+            "id": self._id,
+            "issued": self.issued,
+            "publisher": self.publisher,
+            "acquisition_links": [
+                {"href": link.href, "mimetype": link.mimetype}
+                for link in self.acquisition_links
+            ],
+            "updated": self.updated.isoformat(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "Publication":
+        return cls(
+            title=data["title"],
+            authors=list(data.get("authors", [])),
+            language=data.get("language", ""),
+            identifier=data.get("identifier", ""),
+            description=data.get("description", ""),
+            cover_href=data.get("cover_href", ""),
+            cover_mimetype=data.get("cover_mimetype", ""),
+            _id=data.get("id", ""),
+            issued=data.get("issued", ""),
+            publisher=data.get("publisher", ""),
+            acquisition_links=[
+                AcquisitionLink(link["href"], link["mimetype"])
+                for link in data.get("acquisition_links", [])
+            ],
+            updated=datetime.fromisoformat(data["updated"]),
+        )
+
+
+def get_publication_id(key: str) -> str:
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, "lib2opds:publication:" + key))
@@ -0,0 +1,136 @@
+import os
+import shutil
+import subprocess  # nosec B404
+import sys
+import time
+from pathlib import Path
+from typing import Iterable, Iterator
+
+CLEANUP_SCRIPT = "import shutil, sys\nfor p in sys.argv[1:]: shutil.rmtree(p, True)"
+WRITE_BUFFER_SIZE = 64 * 1024
+
+
+def encode_chunks(data: str | bytes | Iterable[str]) -> Iterator[bytes]:
+    if isinstance(data, bytes):
+        yield data
+    elif isinstance(data, str):
+        yield data.encode()
+    else:
+        for chunk in data:
+            yield chunk.encode()
+
+
+def write_temp_file(fpath: Path, chunks: Iterable[bytes]) -> Path:
+    """Write chunks to a temporary file next to fpath and return its path
+
+    Chunks go through a write buffer as they come, so a document rendered
+    as a stream is never held in memory as a whole.
+    """
+    tmp_fpath = fpath.with_name(f".{fpath.name}.tmp")
+    try:
+        fpath.parent.mkdir(parents=True, exist_ok=True)
+        with tmp_fpath.open("wb", buffering=WRITE_BUFFER_SIZE) as f:
+            for chunk in chunks:
+                f.write(chunk)
+    except OSError:
+        tmp_fpath.unlink(missing_ok=True)
+        raise
+    return tmp_fpath
+
+
+def replace_file(fpath: Path, data: str | bytes | Iterable[str]) -> bool:
+    """Write data to a temporary file and rename it to fpath
+
+    The old file is replaced rather than rewritten, so readers never see a
+    partial file and its hardlinks in other generations keep their content.
+    """
+    try:
+        tmp_fpath = write_temp_file(fpath, encode_chunks(data))
+    except OSError:
+        return False
+    try:
+        os.replace(tmp_fpath, fpath)
+    except OSError:
+        tmp_fpath.unlink(missing_ok=True)
+        return False
+    return True
+
+
+def link_tree(src: Path, dst: Path) -> None:
+    """Recreate the tree of src in dst with hardlinks of its files"""
+    for root, dirs, files in os.walk(src):
+        target_dir = dst / Path(root).relative_to(src)
+        for name in dirs:
+            (target_dir / name).mkdir(exist_ok=True)
+        for name in files:
+            try:
+                os.link(Path(root) / name, target_dir / name)
+            except OSError:
+                shutil.copy2(Path(root) / name, target_dir / name)
+
+
+class StagedPublisher:
+    """Builds the catalog in a new generation directory next to opds_dir
+
+    opds_dir is a symlink to the current generation. It is switched to the
+    new one with a rename, so readers see either the old or the new
+    catalog. Old generations are removed by a background process.
+    """
+
+    opds_dir: Path
+    staging_dir: Path
+
+    def __init__(self, opds_dir: Path):
+        self.opds_dir = opds_dir
+        self.staging_dir = self._get_generation_dir()
+
+    def stage(self, seed: bool = True) -> bool:
+        """Create the staging directory, seeded with the current catalog
+
+        Unchanged feeds and covers are kept as hardlinks, so they are neither
+        copied nor written again.
+        """
+        try:
+            self.staging_dir.mkdir(parents=True)
+            if seed and self.opds_dir.is_dir():
+                link_tree(self.opds_dir, self.staging_dir)
+        except OSError as e:
+            print(f"Can't create staging directory {self.staging_dir}: {e}")
+            return False
+        return True
+
+    def publish(self) -> bool:
+        tmp_link = self.opds_dir.with_name(f".{self.opds_dir.name}.link")
+        try:
+            tmp_link.unlink(missing_ok=True)
+            tmp_link.symlink_to(self.staging_dir.name, target_is_directory=True)
+            if self.opds_dir.is_dir() and not self.opds_dir.is_symlink():
+                # A directory can't be replaced by a symlink atomically, so
+                # the catalog is missing for a moment on the first publish
+                os.rename(self.opds_dir, self._get_generation_dir())
+            os.replace(tmp_link, self.opds_dir)
+        except OSError as e:
+            print(f"Can't publish {self.staging_dir} as {self.opds_dir}: {e}")
+            return False
+        return True
+
+    def cleanup(self) -> list[Path]:
+        """Remove old generations in a background process"""
+        pattern = f".{self.opds_dir.name}.gen-*"
+        result = [
+            d
+            for d in self.opds_dir.parent.glob(pattern)
+            if d != self.staging_dir and d.is_dir() and not d.is_symlink()
+        ]
+        if result:
+            subprocess.Popen(  # nosec B603
+                [sys.executable, "-c", CLEANUP_SCRIPT, *map(str, result)],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+        return result
+
+    def _get_generation_dir(self) -> Path:
+        return self.opds_dir.with_name(f".{self.opds_dir.name}.gen-{time.time_ns()}")
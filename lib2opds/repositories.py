@@ -1,80 +1,117 @@
 import errno
-import hashlib
 import io
 import mimetypes
 import uuid
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass, field
 from datetime import datetime
+from itertools import repeat
 from pathlib import Path
 from typing import Any
 from urllib.parse import quote, urljoin
 
 from PIL import Image
 
+from lib2opds.caches import MetadataCache, get_metadata_cache, get_metadata_cache_key
 from lib2opds.config import Config
 from lib2opds.ebooks import (
     get_ebook_file_by_suffix,
     get_mimetype_by_filename,
 )
-from lib2opds.publications import AcquisitionLink, Publication
+from lib2opds.manifests import BuildManifest, get_file_group_signature
+from lib2opds.outputs import OutputWriter
+from lib2opds.publications import AcquisitionLink, Publication, get_publication_id
+from lib2opds.publishers import replace_file
+from lib2opds.scanner import FileGroup, FileStat, get_file_stat
 from lib2opds.sidecars import (
     CoverSidecarFile,
     MetadataSidecarFile,
     get_cover_sidecar_file,
     get_metadata_sidecar_file,
 )
+from lib2opds.supervisors import ReadError, ReadSupervisor, read_ebook_file
 
 
 class FilesystemRepository:
     config: Config
+    supervisor: ReadSupervisor | None
+    failures: dict[Path, str]
+    known_failures: set[Path]
 
     def __init__(self, config: Config):
         self.config = config
+        self.supervisor = None
+        if config.read_timeout or config.read_memory_limit:
+            self.supervisor = ReadSupervisor(
+                config.read_timeout, config.read_memory_limit
+            )
+        self.failures = {}
+        self.known_failures = set()
+
+    def close(self) -> None:
+        if self.supervisor:
+            self.supervisor.close()
 
     def get_title_by_filename(self, fpath: Path) -> str:
         return str(fpath.stem.replace("_", " ").capitalize())
 
-    def get_publication(self, files: list[Path]) -> Publication | None:
+    def get_publication_key(self, ebook_files: list[Path]) -> str:
+        return str(ebook_files[0].with_suffix("").relative_to(self.config.library_dir))
+
+    def get_publication(
+        self, files: list[Path], stats: dict[Path, FileStat] | None = None
+    ) -> Publication | None:
         ebook_files = self._get_ebook_files(files)
         if not len(ebook_files):
             return None
 
         pub_title: str = self.get_title_by_filename(ebook_files[0])
-        p = Publication(pub_title)
+        pub_id: str = get_publication_id(self.get_publication_key(ebook_files))
+        p = Publication(pub_title, _id=pub_id)
 
-        (metadata, cover) = self._load_metadata_from_files(files)
+        (metadata, cover) = self._load_metadata_from_files(files, stats)
 
         if metadata:
             p = self._init_publication_from_metadata(p, metadata)
         # Save cover to local path and create href for the publication
         if cover:
             local_cover_path = self._get_cover_local_path(p.cover_filename)
-            cover.write(
+            if cover.write(
                 local_cover_path,
                 self.config.cover_quality,
                 self.config.cover_width,
                 self.config.cover_height,
-            )
-            p.cover_href = self._get_cover_href(local_cover_path)
-            p.cover_mimetype = "image/jpeg"
+            ):
+                p.cover_href = self._get_cover_href(local_cover_path)
+                p.cover_mimetype = "image/jpeg"
 
         p.acquisition_links = self._get_acquisition_links(ebook_files)
-        p.updated = self._get_updated_from_ebook_files(ebook_files)
+        p.updated = self._get_updated_from_ebook_files(ebook_files, stats)
         return p
 
-    def _get_updated_from_ebook_files(self, ebook_files: list[Path]) -> datetime:
-        return datetime.fromtimestamp(ebook_files[0].stat().st_mtime)
+    def _get_updated_from_ebook_files(
+        self, ebook_files: list[Path], stats: dict[Path, FileStat] | None = None
+    ) -> datetime:
+        return datetime.fromtimestamp(get_file_stat(ebook_files[0], stats).mtime)
+
+    def _get_cover_size(self) -> tuple[int, int]:
+        return (self.config.cover_width, self.config.cover_height)
+
+    def _get_cover_dir(self) -> Path:
+        return self.config.get_output_dir() / "covers"
+
+    def _get_cover_path(self, cover_filename: str) -> Path:
+        return self.config.get_shard_path(self._get_cover_dir(), cover_filename)
 
     def _get_cover_local_path(self, cover_filename: str) -> Path:
-        cover_dir: Path = self.config.opds_dir / "covers"
-        cover_dir.mkdir(parents=True, exist_ok=True)
-        local_cover_path: Path = cover_dir / cover_filename
+        local_cover_path: Path = self._get_cover_path(cover_filename)
+        local_cover_path.parent.mkdir(parents=True, exist_ok=True)
         return local_cover_path
 
     def _get_cover_href(self, local_cover_path: Path) -> str:
         cover_href = urljoin(
             self.config.opds_base_uri,
-            quote(str(local_cover_path.relative_to(self.config.opds_dir))),
+            quote(str(local_cover_path.relative_to(self.config.get_output_dir()))),
         )
         return cover_href
 
@@ -104,15 +141,21 @@ class FilesystemRepository:
         return result
 
     def _load_metadata_from_ebook_files(
-        self, files: list[Path]
+        self, files: list[Path], stats: dict[Path, FileStat] | None = None
     ) -> tuple[MetadataSidecarFile | None, CoverSidecarFile | None]:
         metadata: MetadataSidecarFile | None = None
         cover: CoverSidecarFile | None = None
         for f in self._get_ebook_files(files):
-            ebook_file = get_ebook_file_by_suffix(f)
-            if not ebook_file:
+            ebook_file = get_ebook_file_by_suffix(f, self._get_cover_size())
+            if not ebook_file or self._is_failed_file(f, stats):
                 continue
-            if not ebook_file.read():
+            # A broken file gets a publication with the title by its filename
+            try:
+                if not (ebook_file := read_ebook_file(ebook_file, self.supervisor)):
+                    self._set_failed_file(f, stats, "not readable")
+                    continue
+            except ReadError as e:
+                self._set_failed_file(f, stats, str(e))
                 continue
             metadata = ebook_file.get_metadata()
             cover = ebook_file.get_cover()
@@ -120,33 +163,75 @@ class FilesystemRepository:
                 break
         return (metadata, cover)
 
+    def _is_failed_file(
+        self, fpath: Path, stats: dict[Path, FileStat] | None = None
+    ) -> bool:
+        return False
+
+    def _set_failed_file(
+        self, fpath: Path, stats: dict[Path, FileStat] | None, reason: str
+    ) -> None:
+        self.failures[fpath] = reason
+
     def _load_metadata_from_sidecar_files(
         self, files: list[Path]
     ) -> tuple[MetadataSidecarFile | None, CoverSidecarFile | None]:
         if not (ebook_path := self._get_ebook_path(files)):
             return (None, None)
+        # Sidecar files share the stem of the ebook file, so they are already
+        # in the file group and there is no need to stat them again
         metadata = get_metadata_sidecar_file(ebook_path)
-        if not metadata.read():
+        if metadata.fpath not in files or not metadata.read():
             return (None, None)
-        cover = get_cover_sidecar_file(ebook_path)
-        if not cover.read():
+        cover = get_cover_sidecar_file(ebook_path, *self._get_cover_size())
+        if cover.fpath not in files or not cover.read():
             return (metadata, None)
         return (metadata, cover)
 
     def _load_metadata_from_files(
-        self, files: list[Path]
+        self, files: list[Path], stats: dict[Path, FileStat] | None = None
     ) -> tuple[MetadataSidecarFile | None, CoverSidecarFile | None]:
-        (metadata, cover) = self._load_metadata_from_ebook_files(files)
         (sidecar_metadata, sidecar_cover) = self._load_metadata_from_sidecar_files(files)
 
+        # Ebook files are not opened if sidecar files provide everything
+        if sidecar_metadata and not self._get_missing_fields(sidecar_metadata):
+            if sidecar_cover or not self.config.ebook_cover_fallback:
+                return (sidecar_metadata, sidecar_cover)
+
+        (metadata, cover) = self._load_metadata_from_ebook_files(files, stats)
+
         if sidecar_metadata:
-            metadata = sidecar_metadata
+            metadata = self._merge_metadata(sidecar_metadata, metadata)
 
         if sidecar_cover:
             cover = sidecar_cover
 
         return (metadata, cover)
 
+    def _get_missing_fields(self, metadata: MetadataSidecarFile) -> list[str]:
+        return [
+            field_name
+            for field_name in self.config.sidecar_fallback_fields
+            if not getattr(metadata, field_name, None)
+        ]
+
+    def _merge_metadata(
+        self,
+        sidecar_metadata: MetadataSidecarFile,
+        ebook_metadata: MetadataSidecarFile | None,
+    ) -> MetadataSidecarFile:
+        """Fill empty fields of the sidecar file from the ebook file
+
+        Only fields listed in sidecar_fallback_fields are filled, others are
+        taken from the sidecar file even if empty.
+        """
+        if ebook_metadata:
+            for field_name in self._get_missing_fields(sidecar_metadata):
+                value = getattr(ebook_metadata, field_name, None)
+                if value:
+                    setattr(sidecar_metadata, field_name, value)
+        return sidecar_metadata
+
     def _update(self, field_name: str, value: Any) -> None:
         if hasattr(self, field_name):
             setattr(self, field_name, value)
@@ -165,70 +250,321 @@ class FilesystemRepository:
 
 
 class CachingFilesystemRepository(FilesystemRepository):
-    def get_publication(self, files: list[Path]) -> Publication | None:
+    cache: MetadataCache | None
+
+    def __init__(self, config: Config):
+        super().__init__(config)
+        self.cache = get_metadata_cache(config)
+
+    def close(self) -> None:
+        super().close()
+        if self.cache:
+            self.cache.close()
+
+    def get_publication(
+        self, files: list[Path], stats: dict[Path, FileStat] | None = None
+    ) -> Publication | None:
         ebook_files = self._get_ebook_files(files)
         if not len(ebook_files):
             return None
 
         pub_title: str = self.get_title_by_filename(ebook_files[0])
-        p = Publication(pub_title)
+        pub_id: str = get_publication_id(self.get_publication_key(ebook_files))
+        p = Publication(pub_title, _id=pub_id)
 
         # Try to load metadata from cache
-        metadata = self._load_metadata_from_cache(files)
-        cover = self._load_cover_from_cache(files)
+        cache_key = self._get_cache_key(files, stats)
+        metadata = self._load_metadata_from_cache(cache_key)
+        cover: CoverSidecarFile | None = None
 
         # Try to load metadata from ebook files and sidecar files
         if metadata == None:
-            (metadata, cover) = self._load_metadata_from_files(files)
+            (metadata, cover) = self._load_metadata_from_legacy_cache(files, stats)
+            if metadata == None:
+                (metadata, cover) = self._load_metadata_from_files(files, stats)
+
+            # Save metadata to cache
+            if metadata and self.cache and cache_key:
+                self.cache.set_metadata(cache_key, metadata)
+                if not cover:
+                    self._set_coverless_in_cache(cache_key, files)
+        elif self._export_cover_from_cache(cache_key, p.cover_filename):
+            # Cached thumbnail was copied as is, there is nothing to decode
+            p.cover_href = self._get_cover_href(
+                self._get_cover_local_path(p.cover_filename)
+            )
+            p.cover_mimetype = "image/jpeg"
+        elif not self._is_coverless_in_cache(cache_key):
+            # Thumbnails of other cover settings are not scaled, the cover is
+            # extracted again from sidecar or ebook files
+            (_, cover) = self._load_metadata_from_files(files, stats)
+            if not cover:
+                self._set_coverless_in_cache(cache_key, files)
 
         if metadata:
             p = self._init_publication_from_metadata(p, metadata)
 
-            # Save metadata to cache
-            if cache_path := self._get_cache_path(files):
-                if metadata:
-                    metadata.write(cache_path.with_suffix(".info"))
-
         # Save cover to local path and create href for the publication
-        if cover:
-            local_cover_path = self._get_cover_local_path(p.cover_filename)
-            cover.write(
-                local_cover_path,
+        if cover and (
+            data := cover.to_bytes(
                 self.config.cover_quality,
                 self.config.cover_width,
                 self.config.cover_height,
             )
-            p.cover_href = self._get_cover_href(local_cover_path)
-            p.cover_mimetype = "image/jpeg"
+        ):
+            local_cover_path = self._get_cover_local_path(p.cover_filename)
+            if self._write_cover(local_cover_path, data):
+                p.cover_href = self._get_cover_href(local_cover_path)
+                p.cover_mimetype = "image/jpeg"
 
-            # Save cover to cache
-            if cache_path:
-                cover.write(cache_path.with_suffix(".cover"), self.config.cover_quality)
+                # Save thumbnail to cache
+                if self.cache and cache_key:
+                    self.cache.set_cover(cache_key, data)
 
         p.acquisition_links = self._get_acquisition_links(ebook_files)
-        p.updated = self._get_updated_from_ebook_files(ebook_files)
+        p.updated = self._get_updated_from_ebook_files(ebook_files, stats)
         return p
 
-    def _load_metadata_from_cache(self, files: list[Path]) -> MetadataSidecarFile | None:
-        if cache_fpath := self._get_cache_path(files):
-            metadata = get_metadata_sidecar_file(cache_fpath)
-            if metadata.read():
-                return metadata
+    def get_cache_keys(
+        self, files: list[Path], stats: dict[Path, FileStat] | None = None
+    ) -> list[str]:
+        """Keys of the file group and its ebook files in the metadata cache"""
+        result: list[str] = []
+        if cache_key := self._get_cache_key(files, stats):
+            result.append(cache_key)
+        for f in self._get_ebook_files(files):
+            if failure_key := self._get_failure_key(f, stats):
+                result.append(failure_key)
+        return result
+
+    def _load_metadata_from_cache(
+        self, cache_key: str | None
+    ) -> MetadataSidecarFile | None:
+        if self.cache and cache_key:
+            return self.cache.get_metadata(cache_key)
         return None
 
-    # TODO use another source for hash
-    def _get_cache_path(self, files: list[Path]) -> Path | None:
-        if self.config.cache_dir and self.config.cache_dir.exists():
-            return (
-                self.config.cache_dir
-                / hashlib.md5(bytes(files[0])).hexdigest()  # nosec B324
+    def _load_metadata_from_legacy_cache(
+        self, files: list[Path], stats: dict[Path, FileStat] | None = None
+    ) -> tuple[MetadataSidecarFile | None, CoverSidecarFile | None]:
+        """Take over the entry stored under the path key by older versions
+
+        The entry is removed, the caller stores it again under the current key.
+        """
+        if not self.cache or self.config.cache_key == "path":
+            return (None, None)
+        legacy_key = get_metadata_cache_key(files, stats, "path")
+        if (metadata := self.cache.get_metadata(legacy_key)) is None:
+            return (None, None)
+        cover = self.cache.get_legacy_cover(legacy_key)
+        self.cache.remove(legacy_key)
+        return (metadata, cover)
+
+    def _get_cache_key(
+        self, files: list[Path], stats: dict[Path, FileStat] | None = None
+    ) -> str | None:
+        if not self.cache:
+            return None
+        try:
+            return get_metadata_cache_key(files, stats, self.config.cache_key)
+        except OSError:
+            return None
+
+    def _get_failure_key(
+        self, fpath: Path, stats: dict[Path, FileStat] | None = None
+    ) -> str | None:
+        if not self.cache:
+            return None
+        # Failures are keyed by the file itself, so a changed file is read again
+        kind = "content" if self.config.cache_key == "content" else "stat"
+        try:
+            return get_metadata_cache_key([fpath], stats, kind)
+        except OSError:
+            return None
+
+    def _is_failed_file(
+        self, fpath: Path, stats: dict[Path, FileStat] | None = None
+    ) -> bool:
+        if self.config.retry_failed:
+            return False
+        if not self.cache or not (key := self._get_failure_key(fpath, stats)):
+            return False
+        if self.cache.get_failure(key) is None:
+            return False
+        self.known_failures.add(fpath)
+        return True
+
+    def _set_failed_file(
+        self, fpath: Path, stats: dict[Path, FileStat] | None, reason: str
+    ) -> None:
+        super()._set_failed_file(fpath, stats, reason)
+        if self.cache and (key := self._get_failure_key(fpath, stats)):
+            self.cache.set_failure(key, reason)
+
+    def _export_cover_from_cache(
+        self, cache_key: str | None, cover_filename: str
+    ) -> bool:
+        if self.cache and cache_key:
+            return self.cache.export_cover(
+                cache_key, self._get_cover_local_path(cover_filename)
             )
-        else:
+        return False
+
+    def _write_cover(self, local_cover_path: Path, data: bytes) -> bool:
+        return replace_file(local_cover_path, data)
+
+    def _is_coverless_in_cache(self, cache_key: str | None) -> bool:
+        if self.cache and cache_key:
+            return self.cache.is_coverless(cache_key)
+        return False
+
+    def _set_coverless_in_cache(self, cache_key: str | None, files: list[Path]) -> None:
+        # Covers of failed files are looked for again by --retry-failed
+        if self.cache and cache_key and not self._has_failed_files(files):
+            self.cache.set_cover(cache_key, b"")
+
+    def _has_failed_files(self, files: list[Path]) -> bool:
+        return any(f in self.failures or f in self.known_failures for f in files)
+
+
+def get_publications_from_file_groups(
+    config: Config, groups: list[FileGroup]
+) -> tuple[list[Publication | None], dict[Path, str], set[Path]]:
+    # Entry point for worker processes, so it has to be a module-level function
+    repo = CachingFilesystemRepository(config)
+    try:
+        publications = [
+            repo.get_publication(group.files, group.stats) for group in groups
+        ]
+        return (publications, repo.failures, repo.known_failures)
+    finally:
+        repo.close()
+
+
+class IncrementalFilesystemRepository(CachingFilesystemRepository):
+    manifest: BuildManifest | None
+    output: OutputWriter | None
+    used_cache_keys: set[str]
+    _prefetched: dict[str, Publication | None]
+
+    def __init__(
+        self,
+        config: Config,
+        manifest: BuildManifest | None = None,
+        output: OutputWriter | None = None,
+    ):
+        super().__init__(config)
+        self.manifest = manifest
+        self.output = output
+        self.used_cache_keys = set()
+        self._prefetched = {}
+
+    def get_publication(
+        self, files: list[Path], stats: dict[Path, FileStat] | None = None
+    ) -> Publication | None:
+        ebook_files = self._get_ebook_files(files)
+        if not len(ebook_files):
             return None
 
-    def _load_cover_from_cache(self, files: list[Path]) -> CoverSidecarFile | None:
-        if cache_fpath := self._get_cache_path(files):
-            cover = get_cover_sidecar_file(cache_fpath)
-            if cover.read():
-                return cover
-        return None
+        key: str = self.get_publication_key(ebook_files)
+        signature = get_file_group_signature(files, stats) if self.manifest else []
+
+        p = self._get_stored_publication(key, signature)
+        cache_keys: list[str] | None = None
+        if p is None:
+            if key in self._prefetched:
+                p = self._prefetched.pop(key)
+            else:
+                p = super().get_publication(files, stats)
+            # Covers of worker processes and the cache are written without
+            # the manifest, they are recorded here if changed
+            if p and p.cover_href and self.output:
+                self.output.add(self._get_cover_path(p.cover_filename))
+        elif self.manifest:
+            cache_keys = self.manifest.get_cache_keys(key)
+        if cache_keys is None:
+            cache_keys = self.get_cache_keys(files, stats)
+        self.used_cache_keys.update(cache_keys)
+
+        # Publications of failed files are not stored, so --retry-failed works
+        if p and self.manifest and not self._has_failed_files(files):
+            self.manifest.add_publication(key, signature, p, cache_keys)
+        return p
+
+    def prune_cache(self) -> int:
+        """Remove cache entries of files which are not in the library anymore
+
+        Must be called after publications of the whole library were got.
+        """
+        if not self.cache:
+            return 0
+        # An empty or unmounted library must not wipe the cache
+        if not self.used_cache_keys:
+            print("No books found in the library, the cache is not pruned")
+            return 0
+        return self.cache.prune(
+            self.used_cache_keys,
+            self.config.cache_prune,
+            self.config.cache_max_size * 1024 * 1024,
+            self.config.cache_prune_limit / 100,
+        )
+
+    def prefetch_publications(self, groups: list[FileGroup], jobs: int) -> None:
+        """Extract publications of new and changed file groups in parallel"""
+        pending: dict[str, FileGroup] = {}
+        for group in groups:
+            if not (ebook_files := self._get_ebook_files(group.files)):
+                continue
+            key: str = self.get_publication_key(ebook_files)
+            signature = (
+                get_file_group_signature(group.files, group.stats)
+                if self.manifest
+                else []
+            )
+            if self._get_stored_publication(key, signature) is None:
+                pending[key] = group
+
+        if not pending:
+            return
+
+        # Create the cache before forking, so workers do not wait for it
+        if self.cache and self.cache.open():
+            self.cache.close()
+
+        # Every worker opens the cache once per chunk and writes it in batches
+        chunksize = max(1, min(64, len(pending) // (jobs * 4)))
+        groups = list(pending.values())
+        chunks = [groups[i : i + chunksize] for i in range(0, len(groups), chunksize)]
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            publications: list[Publication | None] = []
+            for chunk_publications, failures, known_failures in executor.map(
+                get_publications_from_file_groups, repeat(self.config), chunks
+            ):
+                publications.extend(chunk_publications)
+                self.failures.update(failures)
+                self.known_failures.update(known_failures)
+            for key, p in zip(pending.keys(), publications):
+                self._prefetched[key] = p
+
+    def _write_cover(self, local_cover_path: Path, data: bytes) -> bool:
+        # Unchanged covers keep their mtime
+        if self.output:
+            return self.output.write(local_cover_path, data)
+        return super()._write_cover(local_cover_path, data)
+
+    def _get_stored_publication(
+        self, key: str, signature: list[list[Any]]
+    ) -> Publication | None:
+        if self.manifest is None:
+            return None
+        # Reuse the publication stored by the previous run if the file group
+        # is untouched and its cover is still in place
+        p = self.manifest.get_publication(key, signature)
+        if p is None or not self._is_cover_present(p):
+            return None
+        return p
+
+    def _is_cover_present(self, p: Publication) -> bool:
+        if not p.cover_href:
+            return True
+        return self._get_cover_path(p.cover_filename).is_file()
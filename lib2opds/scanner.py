@@ -0,0 +1,222 @@
+import hashlib
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Self
+
+
+@dataclass(frozen=True, slots=True)
+class FileStat:
+    size: int
+    mtime_ns: int
+    inode: int
+
+    @classmethod
+    def from_stat_result(cls, st: os.stat_result) -> Self:
+        return cls(st.st_size, st.st_mtime_ns, st.st_ino)
+
+    @property
+    def mtime(self) -> float:
+        return self.mtime_ns / 1e9
+
+
+@dataclass
+class FileGroup:
+    """Files sharing the same stem, e.g. book.epub, book.pdf and book.info"""
+
+    files: list[Path] = field(default_factory=list)
+    stats: dict[Path, FileStat] = field(default_factory=dict)
+
+    def add(self, fpath: Path, stat: FileStat) -> None:
+        self.files.append(fpath)
+        self.stats[fpath] = stat
+
+
+@dataclass
+class DirectoryState:
+    """What a directory looked like when it was scanned last time"""
+
+    mtime_ns: int
+    digest: str
+    dirs: list[str] = field(default_factory=list)
+    files: dict[str, FileStat] = field(default_factory=dict)
+
+
+@dataclass
+class ScannedDirectory:
+    path: Path
+    mtime_ns: int
+    dirs: list[Self] = field(default_factory=list)
+    file_groups: list[FileGroup] = field(default_factory=list)
+    digest: str = ""
+
+    def get_state(self) -> DirectoryState:
+        result = DirectoryState(self.mtime_ns, self.digest)
+        result.dirs = [d.path.name for d in self.dirs]
+        for group in self.file_groups:
+            for fpath in group.files:
+                result.files[fpath.name] = group.stats[fpath]
+        return result
+
+    def is_empty(self) -> bool:
+        return not self.dirs and not self.file_groups
+
+    def get_all_file_groups(self) -> list[FileGroup]:
+        result: list[FileGroup] = list(self.file_groups)
+        for d in self.dirs:
+            result.extend(d.get_all_file_groups())
+        return result
+
+
+def get_file_stat(fpath: Path, stats: dict[Path, FileStat] | None = None) -> FileStat:
+    if stats and (stat := stats.get(fpath)):
+        return stat
+    return FileStat.from_stat_result(fpath.stat())
+
+
+def group_files_by_stem(files: list[tuple[Path, FileStat]]) -> list[FileGroup]:
+    groups: dict[str, FileGroup] = {}
+    for fpath, stat in files:
+        if (group := groups.get(fpath.stem)) is None:
+            group = groups[fpath.stem] = FileGroup()
+        group.add(fpath, stat)
+    return list(groups.values())
+
+
+def get_listing_digest(dirnames: list[str], filenames: list[str]) -> str:
+    listing = "\0".join(sorted(dirnames)) + "\0\0" + "\0".join(sorted(filenames))
+    return hashlib.sha256(listing.encode(errors="surrogateescape")).hexdigest()
+
+
+def get_dir_listing(dirpath: Path) -> tuple[list[os.DirEntry], list[os.DirEntry]]:
+    dir_entries: list[os.DirEntry] = []
+    file_entries: list[os.DirEntry] = []
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            if entry.is_dir():
+                dir_entries.append(entry)
+            elif entry.is_file():
+                file_entries.append(entry)
+    return (dir_entries, file_entries)
+
+
+def scan_dir(
+    dirpath: Path,
+    mtime_ns: int | None = None,
+    states: dict[Path, DirectoryState] | None = None,
+    check_file_changes: bool = True,
+    stats: dict[Path, FileStat] | None = None,
+) -> ScannedDirectory:
+    """Scan the directory tree stat'ing every file at most once
+
+    Files next to subdirectories are not published, so they are neither
+    grouped nor stat'ed. Directories with the same mtime as in states are
+    not listed again, their files are only stat'ed if check_file_changes
+    is set and they are not in stats collected by is_dir_changed.
+    """
+    if mtime_ns is None:
+        mtime_ns = dirpath.stat().st_mtime_ns
+
+    state = states.get(dirpath) if states else None
+    if state is not None and state.mtime_ns == mtime_ns:
+        try:
+            return rescan_dir(dirpath, state, states, check_file_changes, stats)
+        except FileNotFoundError:
+            pass
+
+    result = ScannedDirectory(dirpath, mtime_ns)
+    (dir_entries, file_entries) = get_dir_listing(dirpath)
+    result.digest = get_listing_digest(
+        [e.name for e in dir_entries], [e.name for e in file_entries]
+    )
+
+    if dir_entries:
+        for entry in dir_entries:
+            result.dirs.append(
+                scan_dir(
+                    Path(entry.path),
+                    entry.stat().st_mtime_ns,
+                    states,
+                    check_file_changes,
+                    stats,
+                )
+            )
+    else:
+        result.file_groups = group_files_by_stem(
+            [
+                (Path(entry.path), get_file_stat(Path(entry.path), stats))
+                for entry in file_entries
+            ]
+        )
+    return result
+
+
+def rescan_dir(
+    dirpath: Path,
+    state: DirectoryState,
+    states: dict[Path, DirectoryState] | None = None,
+    check_file_changes: bool = True,
+    stats: dict[Path, FileStat] | None = None,
+) -> ScannedDirectory:
+    """Rebuild the scan result of an unchanged directory from its state"""
+    result = ScannedDirectory(dirpath, state.mtime_ns, digest=state.digest)
+    for name in state.dirs:
+        subdirpath = dirpath / name
+        result.dirs.append(
+            scan_dir(
+                subdirpath,
+                subdirpath.stat().st_mtime_ns,
+                states,
+                check_file_changes,
+                stats,
+            )
+        )
+
+    files: list[tuple[Path, FileStat]] = []
+    for name, stat in state.files.items():
+        fpath = dirpath / name
+        if check_file_changes:
+            stat = get_file_stat(fpath, stats)
+        files.append((fpath, stat))
+    result.file_groups = group_files_by_stem(files)
+    return result
+
+
+def is_dir_changed(
+    dirpath: Path,
+    states: dict[Path, DirectoryState],
+    check_file_changes: bool = True,
+    stats: dict[Path, FileStat] | None = None,
+) -> bool:
+    """Compare the directory tree with states without listing unchanged directories
+
+    Stats of checked files are added to stats, so the following scan does
+    not stat them again.
+    """
+    if (state := states.get(dirpath)) is None:
+        return True
+    try:
+        if dirpath.stat().st_mtime_ns != state.mtime_ns:
+            # Entries might have been created and removed again
+            (dir_entries, file_entries) = get_dir_listing(dirpath)
+            digest = get_listing_digest(
+                [e.name for e in dir_entries], [e.name for e in file_entries]
+            )
+            if digest != state.digest:
+                return True
+
+        for name in state.dirs:
+            if is_dir_changed(dirpath / name, states, check_file_changes, stats):
+                return True
+
+        if check_file_changes:
+            for name, stat in state.files.items():
+                fpath = dirpath / name
+                current = FileStat.from_stat_result(fpath.stat())
+                if stats is not None:
+                    stats[fpath] = current
+                if current != stat:
+                    return True
+    except FileNotFoundError:
+        return True
+    return False
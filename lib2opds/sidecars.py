@@ -1,10 +1,44 @@
 import configparser
 import errno
+import io
 from dataclasses import dataclass, field
 from pathlib import Path
+from typing import IO, Any
 
 from PIL import Image, ImageOps
 
+from lib2opds.publishers import replace_file
+
+
+def open_cover_image(
+    fp: Path | IO[bytes], size: tuple[int, int] | None = None
+) -> Image.Image:
+    """Open a cover as an RGB image
+
+    JPEG data is decoded at the smallest scale that still covers size, which
+    is much cheaper than decoding a large cover in full and shrinking it.
+    """
+    im: Image.Image = Image.open(fp)
+    if size:
+        im.draft("RGB", size)
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+    return im
+
+
+def is_jpeg_passthrough(im: Image.Image, size: tuple[int, int]) -> bool:
+    """Check if the original bytes of a JPEG can be used as the cover
+
+    Only the header of the opened image is used, so nothing is decoded.
+    """
+    return (
+        im.format == "JPEG"
+        and im.mode in ("RGB", "L")
+        and not im.info.get("progressive")
+        and im.width <= size[0]
+        and im.height <= size[1]
+    )
+
 
 @dataclass
 class SidecarFile:
@@ -24,6 +58,8 @@ class CoverSidecarFile(SidecarFile):
     cover_width: int | None = None
     cover_height: int | None = None
     cover_quality: int | None = None
+    # Original JPEG bytes which are small enough to be used as they are
+    data: bytes | None = None
 
     def read(self) -> bool:
         try:
@@ -35,16 +71,29 @@ class CoverSidecarFile(SidecarFile):
             raise
 
         try:
-            im: Image.Image = Image.open(self.fpath)
-            if im.mode != "RGB":
-                im = im.convert("RGB")
+            data = self.fpath.read_bytes()
+        except OSError:
+            print(f"Can't convert cover for {self.fpath}")
+            return False
+        return self.read_bytes(data)
+
+    def read_bytes(self, data: bytes) -> bool:
+        try:
             if self.cover_width and self.cover_height:
-                im.thumbnail((self.cover_width, self.cover_height))
+                size = (self.cover_width, self.cover_height)
+                im: Image.Image = Image.open(io.BytesIO(data))
+                if is_jpeg_passthrough(im, size):
+                    self.data = data
+                else:
+                    im = open_cover_image(io.BytesIO(data), size)
+                    im.thumbnail(size)
+            else:
+                im = open_cover_image(io.BytesIO(data))
             self.cover = im
-            # TODO fix cover_mimetype
+            # Covers are always written as JPEG
             self.cover_mimetype = "image/jpeg"
             return True
-        except OSError:
+        except (OSError, Image.DecompressionBombError):
             print(f"Can't convert cover for {self.fpath}")
             return False
 
@@ -55,19 +104,35 @@ class CoverSidecarFile(SidecarFile):
         cover_width: int | None = None,
         cover_height: int | None = None,
     ) -> bool:
-        if not self.cover:
+        if not (data := self.to_bytes(cover_quality, cover_width, cover_height)):
             return False
+        fpath = fpath if fpath else self.fpath.with_suffix(".jpg")
+        return replace_file(fpath, data)
+
+    def to_bytes(
+        self,
+        cover_quality: int | None = None,
+        cover_width: int | None = None,
+        cover_height: int | None = None,
+    ) -> bytes | None:
+        if not self.cover:
+            return None
+        if self.data and (
+            not (cover_width and cover_height)
+            or (self.cover.width <= cover_width and self.cover.height <= cover_height)
+        ):
+            return self.data
+        cover_quality = cover_quality if cover_quality else self.cover_quality
+        data = io.BytesIO()
         try:
-            fpath = fpath if fpath else self.fpath.with_suffix(".jpg")
-            cover_quality = cover_quality if cover_quality else self.cover_quality
             if cover_width and cover_height:
                 cover = ImageOps.contain(self.cover, (cover_width, cover_height))
-                cover.save(fpath, "JPEG", quality=cover_quality)
+                cover.save(data, "JPEG", quality=cover_quality)
             else:
-                self.cover.save(fpath, "JPEG", quality=cover_quality)
-            return True
-        except:
-            return False
+                self.cover.save(data, "JPEG", quality=cover_quality)
+        except OSError:
+            return None
+        return data.getvalue()
 
 
 @dataclass
@@ -80,6 +145,28 @@ class MetadataSidecarFile(SidecarFile):
     issued: str = ""
     publisher: str = ""
 
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "title": self.title,
+            "authors": self.authors,
+            "description": self.description,
+            "language": self.language,
+            "identifier": self.identifier,
+            "issued": self.issued,
+            "publisher": self.publisher,
+        }
+
+    def read_dict(self, data: dict[str, Any]) -> bool:
+        # Ebook files leave missing fields as None
+        self.title = data.get("title") or ""
+        self.authors = list(data.get("authors") or [])
+        self.description = data.get("description") or ""
+        self.language = data.get("language") or ""
+        self.identifier = data.get("identifier") or ""
+        self.issued = data.get("issued") or ""
+        self.publisher = data.get("publisher") or ""
+        return True
+
 
 @dataclass
 class InfoSidecarFile(MetadataSidecarFile):
@@ -0,0 +1,117 @@
+import multiprocessing
+import os
+import resource
+from multiprocessing.connection import Connection
+from multiprocessing.process import BaseProcess
+
+from lib2opds.formats import EbookFile
+
+
+class ReadError(Exception):
+    pass
+
+
+def get_address_space_size() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def serve_reads(conn: Connection, memory_limit: int) -> None:
+    # Entry point for the child process, so it has to be a module-level function
+    if memory_limit:
+        limit = get_address_space_size() + memory_limit * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    while True:
+        try:
+            ebook_file: EbookFile = conn.recv()
+        except EOFError:
+            break
+        try:
+            result = ebook_file.read()
+            conn.send((result, ebook_file, ""))
+        except MemoryError:
+            conn.send((False, None, "exceeded memory limit"))
+        except Exception as e:
+            conn.send((False, None, f"{type(e).__name__}: {e}"))
+
+
+class ReadSupervisor:
+    """Reads ebook files in a child process with time and memory limits
+
+    The child process is killed when reading takes longer than timeout
+    seconds and started again for the next file.
+    """
+
+    timeout: float
+    memory_limit: int
+    _process: BaseProcess | None
+    _conn: Connection | None
+
+    def __init__(self, timeout: float = 0, memory_limit: int = 0):
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self._process = None
+        self._conn = None
+
+    def read(self, ebook_file: EbookFile) -> EbookFile | None:
+        """Return the read ebook file or None if it is not readable
+
+        Raises ReadError if reading failed, timed out or crashed.
+        """
+        conn = self._start()
+        conn.send(ebook_file)
+        if not conn.poll(self.timeout if self.timeout else None):
+            self.close()
+            raise ReadError(f"timed out after {self.timeout:g} s")
+
+        try:
+            (result, read_file, error) = conn.recv()
+        except EOFError:
+            self.close()
+            raise ReadError("crashed")
+
+        if error:
+            if error == "exceeded memory limit":
+                self.close()
+            raise ReadError(error)
+        return read_file if result else None
+
+    def close(self) -> None:
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+        if self._process:
+            self._process.kill()
+            self._process.join()
+            self._process = None
+
+    def _start(self) -> Connection:
+        if self._conn and self._process and self._process.is_alive():
+            return self._conn
+        self.close()
+        (self._conn, child_conn) = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=serve_reads, args=(child_conn, self.memory_limit), daemon=True
+        )
+        self._process.start()
+        child_conn.close()
+        return self._conn
+
+
+def read_ebook_file(
+    ebook_file: EbookFile, supervisor: ReadSupervisor | None = None
+) -> EbookFile | None:
+    """Read the ebook file, in the supervisor's child process if there is one
+
+    Raises ReadError instead of any exception of the format reader.
+    """
+    if supervisor:
+        return supervisor.read(ebook_file)
+    try:
+        return ebook_file if ebook_file.read() else None
+    except Exception as e:
+        raise ReadError(f"{type(e).__name__}: {e}") from e
@@ -4,6 +4,7 @@
         <table>
           <xsl:apply-templates select="/atom:feed/atom:entry" />
         </table>
+        <p><xsl:apply-templates select="/atom:feed/atom:link[@rel='first' or @rel='previous' or @rel='next' or @rel='last']" /></p>
 {% endblock %}
 {% block templates %}
   <xsl:template match="atom:entry">
@@ -30,6 +31,17 @@
             </xsl:choose>
         </xsl:element><xsl:if test="position() &lt; last()">, </xsl:if>
   </xsl:template>
+  <xsl:template match="/atom:feed/atom:link[@rel='first' or @rel='previous' or @rel='next' or @rel='last']">
+    <xsl:element name="a">
+      <xsl:attribute name="href"><xsl:value-of select="./@href"/></xsl:attribute>
+      <xsl:choose>
+        <xsl:when test="./@rel = 'first'">First</xsl:when>
+        <xsl:when test="./@rel = 'previous'">Previous</xsl:when>
+        <xsl:when test="./@rel = 'next'">Next</xsl:when>
+        <xsl:otherwise>Last</xsl:otherwise>
+      </xsl:choose>
+    </xsl:element><xsl:text> </xsl:text>
+  </xsl:template>
   <xsl:template match="atom:link[@rel='http://opds-spec.org/image']">
     <xsl:element name="img">
       <xsl:attribute name="src"><xsl:value-of select="./@href"/></xsl:attribute>
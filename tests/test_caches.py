@@ -0,0 +1,175 @@
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from lib2opds.caches import (
+    FilesystemMetadataCache,
+    SqliteMetadataCache,
+    copy_file,
+    get_metadata_cache,
+    get_metadata_cache_key,
+)
+from lib2opds.config import Config
+from lib2opds.sidecars import CoverSidecarFile, MetadataSidecarFile
+
+
+def test_get_metadata_cache(tmp_path: Path) -> None:
+    assert get_metadata_cache(Config()) is None  # nosec B101
+    config = Config(cache_dir=tmp_path)
+    assert type(get_metadata_cache(config)) == SqliteMetadataCache  # nosec B101
+    config.cache_backend = "files"
+    assert type(get_metadata_cache(config)) == FilesystemMetadataCache  # nosec B101
+
+
+def test_sqlite_metadata_cache(tmp_path: Path) -> None:
+    config = Config(cache_dir=tmp_path)
+    metadata = MetadataSidecarFile(tmp_path / "book.epub", "Title", ["Author"])
+    cover = CoverSidecarFile(tmp_path / "book.cover")
+    cover.cover = Image.new("RGB", (10, 20))
+
+    data = cover.to_bytes(70, 5, 5)
+    assert data  # nosec B101
+
+    cache = SqliteMetadataCache(config, tmp_path / "cache.sqlite")
+    cache.set_metadata("book", metadata)
+    cache.set_cover("book", data)
+    cache.close()
+
+    cache = SqliteMetadataCache(config, tmp_path / "cache.sqlite")
+    result = cache.get_metadata("book")
+    assert result and result.to_dict() == metadata.to_dict()  # nosec B101
+    assert cache.get_metadata("other") is None  # nosec B101
+    assert cache.export_cover("book", tmp_path / "cover.jpg")  # nosec B101
+    assert (tmp_path / "cover.jpg").read_bytes() == data  # nosec B101
+    cache.close()
+
+    # Thumbnails of other sizes are not used
+    config.cover_width = 100
+    cache = SqliteMetadataCache(config, tmp_path / "cache.sqlite")
+    assert not cache.export_cover("book", tmp_path / "cover.jpg")  # nosec B101
+    cache.close()
+
+
+@pytest.mark.parametrize("backend", ["files", "sqlite"])
+def test_metadata_cache_failures(tmp_path: Path, backend: str) -> None:
+    cache = get_metadata_cache(Config(cache_dir=tmp_path, cache_backend=backend))
+    assert cache and cache.get_failure("book") is None  # nosec B101
+    cache.set_failure("book", "not readable")
+    cache.close()
+    assert cache.get_failure("book") == "not readable"  # nosec B101
+    cache.close()
+
+
+def test_sqlite_metadata_cache_read_errors(tmp_path: Path) -> None:
+    cache = SqliteMetadataCache(Config(cache_dir=tmp_path), tmp_path / "cache.sqlite")
+    assert cache.open() and cache.connection  # nosec B101
+    for table in ("metadata", "covers", "failures"):
+        cache.connection.execute(f"DROP TABLE {table}")  # nosec B608
+
+    # Broken databases are handled as cache misses
+    assert cache.get_metadata("book") is None  # nosec B101
+    assert not cache.export_cover("book", tmp_path / "cover.jpg")  # nosec B101
+    assert cache.get_failure("book") is None  # nosec B101
+    cache.close()
+
+
+@pytest.mark.parametrize("backend", ["files", "sqlite"])
+def test_metadata_cache_prune(tmp_path: Path, backend: str) -> None:
+    config = Config(cache_dir=tmp_path, cache_backend=backend)
+    cache = get_metadata_cache(config)
+    assert cache  # nosec B101
+    for key in ("old", "used", "deleted"):
+        cache.set_metadata(key, MetadataSidecarFile(tmp_path / key, key))
+        cache.set_cover(key, b"cover" * 100)
+    cache.set_failure("broken", "not readable")
+    cache.close()
+
+    assert cache.prune({"old", "used", "broken"}) == 1  # nosec B101
+    assert cache.get_metadata("deleted") is None  # nosec B101
+    assert cache.prune({"used", "broken"}, False) == 0  # nosec B101
+    assert cache.get_metadata("old")  # nosec B101
+
+    # "old" was used less recently than "used" and "broken"
+    assert cache.prune({"used", "broken"}, False, 1000) == 1  # nosec B101
+    assert cache.get_metadata("old") is None  # nosec B101
+    assert cache.get_metadata("used")  # nosec B101
+    assert cache.get_failure("broken")  # nosec B101
+    cache.close()
+
+
+def test_sqlite_metadata_cache_prune_access_times(tmp_path: Path) -> None:
+    cache = SqliteMetadataCache(Config(cache_dir=tmp_path), tmp_path / "cache.sqlite")
+    cache.set_cover("book", b"cover")
+    cache.flush()
+
+    # Covers are not rewritten for access times without a size limit
+    assert cache.prune({"book"}) == 0  # nosec B101
+    assert cache.connection  # nosec B101
+    query = "SELECT accessed FROM covers WHERE key = 'book'"
+    assert cache.connection.execute(query).fetchone() == (0,)  # nosec B101
+    assert cache.prune({"book"}, max_size=1000) == 0  # nosec B101
+    assert cache.connection.execute(query).fetchone() != (0,)  # nosec B101
+    cache.close()
+
+
+@pytest.mark.parametrize("backend", ["files", "sqlite"])
+def test_metadata_cache_prune_limit(tmp_path: Path, backend: str) -> None:
+    cache = get_metadata_cache(Config(cache_dir=tmp_path, cache_backend=backend))
+    assert cache  # nosec B101
+    for key in ("a", "b", "c"):
+        cache.set_metadata(key, MetadataSidecarFile(tmp_path / key, key))
+    cache.close()
+
+    # Most books are missing, e.g. the library is not mounted
+    assert cache.prune({"a"}, max_unused_share=0.5) == 0  # nosec B101
+    assert cache.get_metadata("c")  # nosec B101
+    assert cache.prune({"a", "b"}, max_unused_share=0.5) == 1  # nosec B101
+    assert cache.get_metadata("c") is None  # nosec B101
+    cache.close()
+
+
+def test_filesystem_metadata_cache_prune_thumbnails(tmp_path: Path) -> None:
+    FilesystemMetadataCache(Config(), tmp_path).set_cover("book", b"old")
+    (tmp_path / "book.cover").write_bytes(b"older")
+    cache = FilesystemMetadataCache(Config(cover_width=300), tmp_path)
+    cache.set_cover("book", b"new")
+
+    assert cache.prune({"book"}) == 0  # nosec B101
+    assert [f.name for f in tmp_path.iterdir()] == [  # nosec B101
+        "book-300x500q70.cover"
+    ]
+
+
+@pytest.mark.parametrize("mode", ["copy", "hardlink", "reflink"])
+def test_copy_file(tmp_path: Path, mode: str) -> None:
+    (tmp_path / "src").write_bytes(b"data")
+    (tmp_path / "dst").write_bytes(b"old data")
+    assert copy_file(tmp_path / "src", tmp_path / "dst", mode)  # nosec B101
+    assert (tmp_path / "dst").read_bytes() == b"data"  # nosec B101
+
+
+def test_sqlite_metadata_cache_import(tmp_path: Path) -> None:
+    config = Config(cache_dir=tmp_path)
+    metadata = MetadataSidecarFile(tmp_path / "book.epub", "Title", ["Author"])
+    FilesystemMetadataCache(config, tmp_path).set_metadata("book", metadata)
+    assert (tmp_path / "book.info").is_file()  # nosec B101
+
+    cache = SqliteMetadataCache(config, tmp_path / "cache.sqlite")
+    result = cache.get_metadata("book")
+    assert result and result.to_dict() == metadata.to_dict()  # nosec B101
+    assert not (tmp_path / "book.info").exists()  # nosec B101
+    cache.close()
+
+
+@pytest.mark.parametrize("kind", ["stat", "content"])
+def test_get_metadata_cache_key(tmp_path: Path, kind: str) -> None:
+    book = tmp_path / "book.epub"
+    book.write_bytes(b"book" * 100000)
+    key = get_metadata_cache_key([book], kind=kind)
+
+    moved = book.rename(tmp_path / "moved.epub")
+    assert get_metadata_cache_key([moved], kind=kind) == key  # nosec B101
+
+    moved.write_bytes(b"new book")
+    assert get_metadata_cache_key([moved], kind=kind) != key  # nosec B101
@@ -0,0 +1,42 @@
+from pathlib import Path
+
+import pytest
+
+from lib2opds.config import Config
+
+
+def test_get_shard_path() -> None:
+    name = "abcdef12-3456.jpg"
+    assert Config().get_shard_path(Path("covers"), name) == Path(  # nosec B101
+        "covers/abcdef12-3456.jpg"
+    )
+    config = Config(shard_depth=2)
+    assert config.get_shard_path(Path("covers"), name) == Path(  # nosec B101
+        "covers/ab/cd/abcdef12-3456.jpg"
+    )
+
+
+def test_load_from_file_choices(tmp_path: Path) -> None:
+    config_path = tmp_path / "config.ini"
+    config_path.write_text(
+        "[General]\ncache_key = content\ncover_copy_mode = reflink\n"
+        "publish_mode = staged\n"
+    )
+    config = Config()
+    assert config.load_from_file(config_path)  # nosec B101
+    assert config.cache_key == "content"  # nosec B101
+    assert config.cover_copy_mode == "reflink"  # nosec B101
+    assert config.publish_mode == "staged"  # nosec B101
+
+    for value in ("cache_backend = sqlte", "publish_mode = stagged"):
+        config_path.write_text(f"[General]\n{value}\n")
+        with pytest.raises(ValueError, match=value.split(" = ")[1]):
+            config.load_from_file(config_path)
+
+
+@pytest.mark.parametrize("field_name", ["shard_depth", "page_size"])
+def test_load_from_file_negative(tmp_path: Path, field_name: str) -> None:
+    config_path = tmp_path / "config.ini"
+    config_path.write_text(f"[General]\n{field_name} = -1\n")
+    with pytest.raises(ValueError, match=field_name):
+        Config().load_from_file(config_path)
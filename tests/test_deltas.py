@@ -0,0 +1,67 @@
+import json
+import shutil
+from pathlib import Path
+
+from lib2opds.deltas import apply_delta, write_delta
+from lib2opds.outputs import OutputWriter
+
+
+def test_write_and_apply_delta(tmp_path: Path) -> None:
+    out = tmp_path / "out"
+    output = OutputWriter(out, tmp_path / "outputs.json")
+    output.write(out / "index.xml", "index")
+    output.write(out / "old.xml", "old")
+    output.save()
+    shutil.copytree(out, tmp_path / "mirror")
+
+    output = OutputWriter(out, tmp_path / "outputs.json")
+    output.load()
+    output.write(out / "index.xml", "new index")
+    output.write(out / "covers" / "cover.jpg", b"cover")
+    (out / "old.xml").unlink()
+    output.remove(out / "old.xml")
+    delta = write_delta(output, tmp_path / "deltas")
+    assert delta  # nosec B101
+
+    assert apply_delta(delta, tmp_path / "mirror")  # nosec B101
+    assert (tmp_path / "mirror" / "index.xml").read_text() == "new index"  # nosec B101
+    assert (tmp_path / "mirror" / "covers" / "cover.jpg").is_file()  # nosec B101
+    assert not (tmp_path / "mirror" / "old.xml").exists()  # nosec B101
+
+    # Mirrors which differ from the base of the delta are not touched
+    (tmp_path / "other").mkdir()
+    (tmp_path / "other" / "index.xml").write_text("other index")
+    assert not apply_delta(delta, tmp_path / "other")  # nosec B101
+    assert (tmp_path / "other" / "index.xml").read_text() == "other index"  # nosec B101
+
+    # Content which doesn't match the hashes is rejected
+    data = json.loads(delta.read_text())
+    data["files"]["covers/cover.jpg"]["new"] = "0" * 64
+    delta.write_text(json.dumps(data))
+    assert not apply_delta(delta, tmp_path / "mirror", force=True)  # nosec B101
+
+
+def test_delta_of_cleared_output(tmp_path: Path) -> None:
+    out = tmp_path / "out"
+    output = OutputWriter(out, tmp_path / "outputs.json")
+    for name in ("index.xml", "feed.xml", "old.xml"):
+        output.write(out / name, name)
+    output.save()
+    shutil.copytree(out, tmp_path / "mirror")
+
+    # With clear_opds_dir every file is written again, wiped ones are removed
+    shutil.rmtree(out)
+    output = OutputWriter(out, tmp_path / "outputs.json")
+    output.load(skip_unchanged=False)
+    output.write(out / "index.xml", "index.xml")
+    output.write(out / "feed.xml", "new feed")
+    output.write(out / "new.xml", "new")
+    delta = write_delta(output, tmp_path / "deltas")
+    assert delta  # nosec B101
+    files = json.loads(delta.read_text())["files"]
+    assert sorted(files) == ["feed.xml", "new.xml", "old.xml"]  # nosec B101
+    assert files["feed.xml"]["old"]  # nosec B101
+
+    assert apply_delta(delta, tmp_path / "mirror")  # nosec B101
+    assert (tmp_path / "mirror" / "feed.xml").read_text() == "new feed"  # nosec B101
+    assert not (tmp_path / "mirror" / "old.xml").exists()  # nosec B101
@@ -0,0 +1,32 @@
+from datetime import datetime
+from pathlib import Path
+
+from lib2opds.config import Config
+from lib2opds.exporters import export_feeds
+from lib2opds.feeds import AcquisitionFeed, NavigationFeed
+from lib2opds.publications import Publication
+
+
+def export_catalog(opds_dir: Path, export_jobs: int) -> dict[str, bytes]:
+    config = Config(opds_dir=opds_dir, page_size=2, export_jobs=export_jobs)
+    updated = datetime(2024, 1, 1)
+    root = NavigationFeed(config, None, None, "Library", key="root")
+    for name in ("Folder", "Another folder"):
+        feed = AcquisitionFeed(config, root, root, name, key=f"directory:{name}")
+        for title in ("c", "B", "a", "d", "E"):
+            feed.publications.append(Publication(title, _id=title, updated=updated))
+        root.entries.append(feed)
+    root.sort()
+
+    export_feeds(config, root, ["xml", "html"])
+    return {
+        str(fpath.relative_to(opds_dir)): fpath.read_bytes()
+        for fpath in opds_dir.rglob("*")
+        if fpath.is_file()
+    }
+
+
+def test_export_feeds_in_parallel(tmp_path: Path) -> None:
+    files = export_catalog(tmp_path / "sequential", 1)
+    assert len(files) == 14  # nosec B101
+    assert export_catalog(tmp_path / "parallel", 2) == files  # nosec B101
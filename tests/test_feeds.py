@@ -0,0 +1,30 @@
+from pathlib import Path
+
+from lib2opds.config import Config
+from lib2opds.feeds import AcquisitionFeed, NavigationFeed
+from lib2opds.publications import Publication
+
+
+def test_acquisition_feed_pages(tmp_path: Path) -> None:
+    config = Config(opds_dir=tmp_path, page_size=2)
+    root = NavigationFeed(config, None, None, "Library", key="root")
+    feed = AcquisitionFeed(config, root, root, "Folder", key="directory:folder")
+    for title in ("c", "B", "a", "d", "E"):
+        feed.publications.append(Publication(title))
+    feed.sort()
+
+    pages = list(feed.get_pages())
+    assert [page.number for page in pages] == [1, 2, 3]  # nosec B101
+    assert [[p.title for p in page.publications] for page in pages] == [  # nosec B101
+        ["a", "B"],
+        ["c", "d"],
+        ["E"],
+    ]
+    assert feed.get_local_path_xml(1).name == f"{feed.id}.xml"  # nosec B101
+    assert feed.get_local_path_xml(3).name == f"{feed.id}-3.xml"  # nosec B101
+    assert len(feed.get_local_paths()) == 6  # nosec B101
+
+    feed.export_as_xml(recursive=False)
+    xml = feed.get_local_path_xml(2).read_text()
+    assert 'rel="previous"' in xml and 'rel="next"' in xml  # nosec B101
+    assert feed.get_link_self_href_xml(3) in xml  # nosec B101
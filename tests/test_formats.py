@@ -0,0 +1,91 @@
+import zipfile
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from lib2opds.formats.epub import EpubFile
+from lib2opds.formats.pdf import PdfFile
+
+CONTAINER = """<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>"""
+
+PACKAGE = """<?xml version="1.0"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:title>Title</dc:title>
+    <dc:creator>Author 1</dc:creator>
+    <dc:creator>Author 2</dc:creator>
+    <dc:language>en</dc:language>
+  </metadata>
+  <manifest>
+    <item id="chapter" href="chapter.xhtml" media-type="application/xhtml+xml"/>
+  </manifest>
+  <spine><itemref idref="chapter"/></spine>
+</package>"""
+
+
+def test_epub_file(tmp_path: Path) -> None:
+    fpath = tmp_path / "book.epub"
+    with zipfile.ZipFile(fpath, "w") as zip:
+        zip.writestr("mimetype", "application/epub+zip")
+        zip.writestr("META-INF/container.xml", CONTAINER)
+        zip.writestr("OEBPS/content.opf", PACKAGE)
+        zip.writestr("OEBPS/chapter.xhtml", "chapter" * 100000)
+
+    book = EpubFile(fpath)
+    assert book.read()  # nosec B101
+    metadata = book.get_metadata()
+    assert metadata.title == "Title"  # nosec B101
+    assert metadata.authors == ["Author 1", "Author 2"]  # nosec B101
+    assert metadata.language == "en"  # nosec B101
+    assert 0 < book.bytes_read < fpath.stat().st_size // 10  # nosec B101
+
+
+def test_epub_file_not_zip(tmp_path: Path) -> None:
+    fpath = tmp_path / "book.epub"
+    fpath.write_bytes(b"not a zip file")
+    assert not EpubFile(fpath).read()  # nosec B101
+
+
+def test_epub_file_malformed(tmp_path: Path) -> None:
+    fpath = tmp_path / "book.epub"
+    with zipfile.ZipFile(fpath, "w") as zip:
+        zip.writestr("mimetype", "application/epub+zip")
+        zip.writestr("META-INF/container.xml", CONTAINER.replace("full-path", "path"))
+    assert not EpubFile(fpath).read()  # nosec B101
+
+    # Cover without id or href is skipped
+    for meta, item in (
+        ('<meta name="cover"/>', ""),
+        ('<meta name="cover" content="cover"/>', '<item id="cover"/>'),
+    ):
+        package = PACKAGE.replace("</metadata>", meta + "</metadata>")
+        with zipfile.ZipFile(fpath, "w") as zip:
+            zip.writestr("mimetype", "application/epub+zip")
+            zip.writestr("META-INF/container.xml", CONTAINER)
+            zip.writestr(
+                "OEBPS/content.opf", package.replace("</manifest>", item + "</manifest>")
+            )
+        book = EpubFile(fpath)
+        assert book.read()  # nosec B101
+        assert book.get_metadata().title == "Title"  # nosec B101
+        assert book.get_cover().cover is None  # nosec B101
+
+
+def test_pdf_file(tmp_path: Path) -> None:
+    fpath = tmp_path / "book.pdf"
+    cover = Image.new("RGB", (300, 400), "blue")
+    page = Image.new("RGB", (600, 800), "red")
+    cover.save(fpath, save_all=True, append_images=[page])
+
+    book = PdfFile(fpath, (500, 500))
+    assert book.read()  # nosec B101
+    # Small JPEG of the first page is used as it is
+    result = book.get_cover()
+    assert result.cover and result.cover.size == (300, 400)  # nosec B101
+    assert result.data  # nosec B101
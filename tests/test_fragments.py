@@ -0,0 +1,27 @@
+from pathlib import Path
+
+from lib2opds.fragments import FragmentCache
+from lib2opds.publications import Publication
+
+
+def test_fragment_cache(tmp_path: Path) -> None:
+    fpath = tmp_path / "fragments.sqlite"
+    book = Publication("Book", _id="book")
+    other = Publication("Other", _id="other")
+
+    fragments = FragmentCache(fpath, "v1")
+    assert fragments.get_entry(book, "xml") is None  # nosec B101
+    fragments.set_entry(book, "xml", "<entry>Book</entry>")
+    fragments.set_entry(other, "xml", "<entry>Other</entry>")
+    fragments.close([book, other])
+
+    fragments = FragmentCache(fpath, "v1")
+    assert fragments.get_entry(book, "xml") == "<entry>Book</entry>"  # nosec B101
+    assert fragments.get_entry(book, "html") is None  # nosec B101
+    fragments.close([book])
+
+    # Entries of removed publications and of other template versions are gone
+    fragments = FragmentCache(fpath, "v1")
+    assert fragments.get_entry(other, "xml") is None  # nosec B101
+    fragments.close()
+    assert FragmentCache(fpath, "v2").get_entry(book, "xml") is None  # nosec B101
@@ -0,0 +1,61 @@
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+from lib2opds.config import Config
+from lib2opds.feeds import AcquisitionFeed, NavigationFeed
+from lib2opds.manifests import BuildManifest, FeedManifest, get_file_group_signature
+from lib2opds.publications import AcquisitionLink, Publication
+
+
+def test_build_manifest(tmp_path: Path) -> None:
+    book = tmp_path / "book.epub"
+    book.write_bytes(b"book")
+    signature = get_file_group_signature([book])
+    p = Publication(
+        "Title",
+        authors=["Author"],
+        acquisition_links=[AcquisitionLink("/library/book.epub", "application/epub+zip")],
+    )
+
+    manifest = BuildManifest(tmp_path / "manifest.json", Config())
+    manifest.add_publication("book", signature, p, ["cache-key"])
+    assert manifest.save()  # nosec B101
+
+    manifest = BuildManifest(tmp_path / "manifest.json", Config())
+    assert manifest.load()  # nosec B101
+    assert manifest.get_publication("book", signature) == p  # nosec B101
+    assert manifest.get_cache_keys("book") == ["cache-key"]  # nosec B101
+
+    book.write_bytes(b"changed book")
+    signature = get_file_group_signature([book])
+    assert manifest.get_publication("book", signature) is None  # nosec B101
+
+
+def test_feed_manifest(tmp_path: Path) -> None:
+    config = Config(opds_dir=tmp_path)
+    updated = datetime(2024, 1, 1)
+
+    def get_catalog(title: str) -> NavigationFeed:
+        root = NavigationFeed(config, None, None, "Library", key="root")
+        feed = AcquisitionFeed(config, root, root, "Folder", key="directory:folder")
+        feed.publications.append(Publication(title, _id="id", updated=updated))
+        root.entries.append(feed)
+        return root
+
+    manifest = FeedManifest(tmp_path / "feeds.json", config)
+    manifest.update(get_catalog("Title"))
+    assert manifest.save()  # nosec B101
+
+    manifest = FeedManifest(tmp_path / "feeds.json", config)
+    assert manifest.load()  # nosec B101
+    catalog = get_catalog("Title")
+    manifest.update(catalog)
+    assert not catalog.changed and not catalog.entries[0].changed  # nosec B101
+
+    manifest = FeedManifest(tmp_path / "feeds.json", config)
+    assert manifest.load()  # nosec B101
+    catalog = get_catalog("Another title")
+    manifest.update(catalog)
+    assert catalog.changed and catalog.entries[0].changed  # nosec B101
@@ -0,0 +1,87 @@
+import io
+import zipfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from lib2opds.config import Config
+from lib2opds.exporters import export_feeds
+from lib2opds.opds import PublicationIndex, lib2odps
+from lib2opds.publications import Publication
+
+CONTAINER = """<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>"""
+
+PACKAGE = """<?xml version="1.0"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:title>{}</dc:title>
+    <dc:creator>Author</dc:creator>
+    <meta name="cover" content="cover-image"/>
+  </metadata>
+  <manifest>
+    <item id="cover-image" href="cover.jpg" media-type="image/jpeg"/>
+  </manifest>
+</package>"""
+
+
+def test_publication_index() -> None:
+    old = datetime.now() - timedelta(days=365)
+    publications = [
+        Publication("Foundation", authors=["Isaac Asimov"], issued="1951", updated=old),
+        Publication("I, Robot", authors=["Isaac Asimov"], issued="1950-12-02"),
+        Publication("Dune", authors=["Frank Herbert"], language="en", updated=old),
+    ]
+    index = PublicationIndex.from_publications(Config(), publications)
+
+    assert index.author_letters == {"I", "A", "F", "H"}  # nosec B101
+    assert index.by_author["Isaac Asimov"] == publications[:2]  # nosec B101
+    assert index.by_title_letter["D"] == [publications[2]]  # nosec B101
+    assert index.by_language == {"en": [publications[2]]}  # nosec B101
+    assert index.issued_decades == {"1950s"}  # nosec B101
+    assert index.new_publications == [publications[1]]  # nosec B101
+
+
+def build_catalog(tmp_path: Path, library_dir: Path, jobs: int) -> dict[str, bytes]:
+    opds_dir = tmp_path / f"opds-{jobs}"
+    cache_dir = tmp_path / f"cache-{jobs}"
+    cache_dir.mkdir()
+    config = Config(
+        library_dir=library_dir,
+        opds_dir=opds_dir,
+        cache_dir=cache_dir,
+        jobs=jobs,
+        export_jobs=1,
+        generate_random_book_feed=False,
+    )
+    export_feeds(config, lib2odps(config, library_dir), ["xml", "html"])
+    return {
+        str(fpath.relative_to(opds_dir)): fpath.read_bytes()
+        for fpath in opds_dir.rglob("*")
+        if fpath.is_file()
+    }
+
+
+def test_lib2opds_in_parallel(tmp_path: Path) -> None:
+    library_dir = tmp_path / "library"
+    for folder in ("Fiction", "Science"):
+        (library_dir / folder).mkdir(parents=True)
+        for n, color in enumerate(("red", "green", "blue")):
+            cover = io.BytesIO()
+            Image.new("RGB", (600, 800), color).save(cover, "JPEG")
+            with zipfile.ZipFile(library_dir / folder / f"book{n}.epub", "w") as zip:
+                zip.writestr("mimetype", "application/epub+zip")
+                zip.writestr("META-INF/container.xml", CONTAINER)
+                zip.writestr("OEBPS/content.opf", PACKAGE.format(f"{folder} {n}"))
+                zip.writestr("OEBPS/cover.jpg", cover.getvalue())
+    (library_dir / "Science" / "broken.epub").write_bytes(b"not a zip file")
+
+    files = build_catalog(tmp_path, library_dir, 1)
+    assert len([f for f in files if f.startswith("covers/")]) == 6  # nosec B101
+    assert build_catalog(tmp_path, library_dir, 2) == files  # nosec B101
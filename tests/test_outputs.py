@@ -0,0 +1,25 @@
+from pathlib import Path
+
+from lib2opds.outputs import OutputWriter
+
+
+def test_output_writer(tmp_path: Path) -> None:
+    out = tmp_path / "out"
+    output = OutputWriter(out, tmp_path / "outputs.json")
+    assert output.write(out / "feeds" / "feed.xml", "feed")  # nosec B101
+    assert output.write(out / "index.xml", "index")  # nosec B101
+    assert output.save()  # nosec B101
+    mtime_ns = (out / "index.xml").stat().st_mtime_ns
+
+    output = OutputWriter(out, tmp_path / "outputs.json")
+    assert output.load()  # nosec B101
+    assert output.write(out / "feeds" / "feed.xml", "changed feed")  # nosec B101
+    assert output.write(out / "index.xml", "index")  # nosec B101
+    assert output.write(out / "index.xml", iter(["ind", "ex"]))  # nosec B101
+    output.remove(out / "old.xml")
+    assert (out / "index.xml").stat().st_mtime_ns == mtime_ns  # nosec B101
+    assert (out / "feeds" / "feed.xml").read_text() == "changed feed"  # nosec B101
+
+    assert output.write_changed_paths(tmp_path / "changed.txt")  # nosec B101
+    changed = (tmp_path / "changed.txt").read_text()
+    assert changed == "feeds/feed.xml\nold.xml\n"  # nosec B101
@@ -0,0 +1,25 @@
+from pathlib import Path
+
+from lib2opds.publishers import StagedPublisher, replace_file
+
+
+def test_staged_publisher(tmp_path: Path) -> None:
+    opds_dir = tmp_path / "opds"
+    (opds_dir / "feeds").mkdir(parents=True)
+    (opds_dir / "feeds" / "feed.xml").write_text("old feed")
+    (opds_dir / "index.xml").write_text("old index")
+
+    publisher = StagedPublisher(opds_dir)
+    assert publisher.stage()  # nosec B101
+    staged_index = publisher.staging_dir / "index.xml"
+    assert staged_index.stat().st_nlink == 2  # nosec B101
+
+    # Writes to the staging directory don't change the published catalog
+    assert replace_file(staged_index, "new index")  # nosec B101
+    assert (opds_dir / "index.xml").read_text() == "old index"  # nosec B101
+
+    assert publisher.publish()  # nosec B101
+    assert opds_dir.is_symlink()  # nosec B101
+    assert (opds_dir / "index.xml").read_text() == "new index"  # nosec B101
+    assert (opds_dir / "feeds" / "feed.xml").read_text() == "old feed"  # nosec B101
+    assert len(publisher.cleanup()) == 1  # nosec B101
@@ -0,0 +1,197 @@
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from lib2opds.caches import get_metadata_cache_key
+from lib2opds.config import Config
+from lib2opds.formats.epub import EpubFile
+from lib2opds.repositories import (
+    CachingFilesystemRepository,
+    FilesystemRepository,
+    IncrementalFilesystemRepository,
+)
+from lib2opds.sidecars import InfoSidecarFile, MetadataSidecarFile
+
+
+def write_book(dirpath: Path) -> list[Path]:
+    files = [dirpath / "book.epub", dirpath / "book.info", dirpath / "book.cover"]
+    files[0].write_bytes(b"book")
+    files[1].write_text("[Publication]\ntitle = Sidecar title\nauthors = Author\n")
+    Image.new("RGB", (10, 10)).save(files[2], "JPEG")
+    return files
+
+
+def test_sidecar_files_first(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    files = write_book(tmp_path)
+    repo = FilesystemRepository(Config(library_dir=tmp_path))
+
+    def load_metadata_from_ebook_files(files: list[Path], stats: None) -> None:
+        raise AssertionError("ebook files are read")
+
+    monkeypatch.setattr(
+        repo, "_load_metadata_from_ebook_files", load_metadata_from_ebook_files
+    )
+    (metadata, cover) = repo._load_metadata_from_files(files)
+    assert metadata and metadata.title == "Sidecar title"  # nosec B101
+    assert cover and cover.cover  # nosec B101
+
+
+def test_sidecar_fallback_fields(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    files = write_book(tmp_path)
+    config = Config(library_dir=tmp_path, sidecar_fallback_fields=["language"])
+    repo = FilesystemRepository(config)
+
+    def load_metadata_from_ebook_files(files: list[Path], stats: None) -> tuple:
+        return (MetadataSidecarFile(files[0], "Ebook title", language="en"), None)
+
+    monkeypatch.setattr(
+        repo, "_load_metadata_from_ebook_files", load_metadata_from_ebook_files
+    )
+    (metadata, cover) = repo._load_metadata_from_files(files)
+    assert metadata and metadata.title == "Sidecar title"  # nosec B101
+    assert metadata.language == "en"  # nosec B101
+
+
+def test_failed_files(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr("lib2opds.repositories.get_ebook_file_by_suffix", EpubFile)
+    (tmp_path / "cache").mkdir()
+    (tmp_path / "broken.epub").write_bytes(b"not a zip file")
+    config = Config(library_dir=tmp_path, cache_dir=tmp_path / "cache")
+
+    repo = CachingFilesystemRepository(config)
+    (metadata, cover) = repo._load_metadata_from_ebook_files([tmp_path / "broken.epub"])
+    repo.close()
+    assert metadata is None  # nosec B101
+    assert tmp_path / "broken.epub" in repo.failures  # nosec B101
+
+    # The file is skipped until it changes or retries are forced
+    repo = CachingFilesystemRepository(config)
+    repo._load_metadata_from_ebook_files([tmp_path / "broken.epub"])
+    repo.close()
+    assert not repo.failures  # nosec B101
+    assert repo.known_failures == {tmp_path / "broken.epub"}  # nosec B101
+
+    config.retry_failed = True
+    repo = CachingFilesystemRepository(config)
+    repo._load_metadata_from_ebook_files([tmp_path / "broken.epub"])
+    repo.close()
+    assert tmp_path / "broken.epub" in repo.failures  # nosec B101
+
+
+@pytest.mark.parametrize("backend", ["files", "sqlite"])
+def test_cover_size_changed(tmp_path: Path, backend: str) -> None:
+    library_dir = tmp_path / "library"
+    library_dir.mkdir()
+    (tmp_path / "cache").mkdir()
+    files = write_book(library_dir)
+    Image.new("RGB", (1000, 1000)).save(files[2], "JPEG")
+
+    for width in (500, 300):
+        config = Config(
+            library_dir=library_dir,
+            opds_dir=tmp_path / f"opds-{width}",
+            cache_dir=tmp_path / "cache",
+            cache_backend=backend,
+            cover_width=width,
+        )
+        repo = CachingFilesystemRepository(config)
+        p = repo.get_publication(files)
+        repo.close()
+        assert p and p.cover_href  # nosec B101
+        with Image.open(config.opds_dir / p.cover_href) as im:
+            assert im.size == (width, width)  # nosec B101
+
+
+def test_prune_cache_empty_library(tmp_path: Path) -> None:
+    (tmp_path / "cache").mkdir()
+    files = write_book(tmp_path)
+    config = Config(
+        library_dir=tmp_path, opds_dir=tmp_path / "opds", cache_dir=tmp_path / "cache"
+    )
+    repo = IncrementalFilesystemRepository(config)
+    assert repo.get_publication(files)  # nosec B101
+    repo.close()
+
+    # Nothing is found in an unmounted library, the cache is kept
+    repo = IncrementalFilesystemRepository(config)
+    assert repo.prune_cache() == 0  # nosec B101
+    repo.close()
+    cache_key = get_metadata_cache_key(files)
+    assert repo.cache and repo.cache.get_metadata(cache_key)  # nosec B101
+    repo.close()
+
+
+@pytest.mark.parametrize("backend", ["files", "sqlite"])
+def test_legacy_cache_upgraded(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, backend: str
+) -> None:
+    (tmp_path / "cache").mkdir()
+    files = [tmp_path / "book.epub"]
+    files[0].write_bytes(b"book")
+    # Older versions kept metadata and covers in their original size under
+    # the path key in the filesystem backend
+    legacy_key = get_metadata_cache_key(files, kind="path")
+    legacy_path = tmp_path / "cache" / legacy_key
+    InfoSidecarFile(legacy_path.with_suffix(".info"), "Cached title").write()
+    Image.new("RGB", (1000, 1000)).save(legacy_path.with_suffix(".cover"), "JPEG")
+
+    config = Config(
+        library_dir=tmp_path,
+        opds_dir=tmp_path / "opds",
+        cache_dir=tmp_path / "cache",
+        cache_backend=backend,
+    )
+    for _ in range(2):
+        repo = CachingFilesystemRepository(config)
+
+        def load_metadata_from_files(files: list[Path], stats: None) -> None:
+            raise AssertionError("files are read")
+
+        monkeypatch.setattr(repo, "_load_metadata_from_files", load_metadata_from_files)
+        p = repo.get_publication(files)
+        repo.close()
+        assert p and p.title == "Cached title"  # nosec B101
+        assert p.cover_href  # nosec B101
+        with Image.open(config.opds_dir / p.cover_href) as im:
+            assert im.size == (config.cover_width, config.cover_width)  # nosec B101
+
+    # The entry was moved to the current key
+    cache_key = get_metadata_cache_key(files)
+    assert repo.cache and repo.cache.get_metadata(cache_key)  # nosec B101
+    assert not repo.cache.get_metadata(legacy_key)  # nosec B101
+    repo.close()
+
+
+@pytest.mark.parametrize("backend", ["files", "sqlite"])
+def test_coverless_book_cached(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, backend: str
+) -> None:
+    (tmp_path / "cache").mkdir()
+    files = [tmp_path / "book.epub"]
+    files[0].write_bytes(b"book")
+    loaded: list[int] = []
+
+    for width in (500, 500, 300):
+        config = Config(
+            library_dir=tmp_path,
+            opds_dir=tmp_path / "opds",
+            cache_dir=tmp_path / "cache",
+            cache_backend=backend,
+            cover_width=width,
+        )
+        repo = CachingFilesystemRepository(config)
+
+        def load_metadata_from_ebook_files(files: list[Path], stats: None) -> tuple:
+            loaded.append(width)
+            return (MetadataSidecarFile(files[0], "Ebook title"), None)
+
+        monkeypatch.setattr(
+            repo, "_load_metadata_from_ebook_files", load_metadata_from_ebook_files
+        )
+        p = repo.get_publication(files)
+        repo.close()
+        assert p and p.title == "Ebook title" and not p.cover_href  # nosec B101
+
+    # The missing cover is looked for again only with other cover settings
+    assert loaded == [500, 300]  # nosec B101
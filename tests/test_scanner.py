@@ -0,0 +1,61 @@
+from pathlib import Path
+
+import pytest
+
+from lib2opds.scanner import FileStat, is_dir_changed, scan_dir
+
+
+def test_scan_dir(tmp_path: Path) -> None:
+    (tmp_path / "shelf").mkdir()
+    for name in ("book.epub", "book.pdf", "book.info", "other.epub"):
+        (tmp_path / "shelf" / name).write_bytes(b"data")
+    (tmp_path / "ignored.epub").write_bytes(b"data")
+
+    library = scan_dir(tmp_path)
+    assert library.file_groups == []  # nosec B101
+    assert len(library.dirs) == 1  # nosec B101
+
+    groups = {g.files[0].stem: g for g in library.dirs[0].file_groups}
+    assert sorted(groups) == ["book", "other"]  # nosec B101
+    assert len(groups["book"].files) == 3  # nosec B101
+    for fpath in groups["book"].files:
+        assert groups["book"].stats[fpath].size == 4  # nosec B101
+
+
+def test_is_dir_changed(tmp_path: Path) -> None:
+    (tmp_path / "shelf").mkdir()
+    (tmp_path / "shelf" / "book.epub").write_bytes(b"data")
+
+    library = scan_dir(tmp_path)
+    states = {tmp_path: library.get_state()}
+    states[tmp_path / "shelf"] = library.dirs[0].get_state()
+    assert not is_dir_changed(tmp_path, states)  # nosec B101
+
+    rescanned = scan_dir(tmp_path, states=states)
+    assert rescanned.dirs[0].file_groups == library.dirs[0].file_groups  # nosec B101
+
+    (tmp_path / "shelf" / "book.epub").write_bytes(b"new data")
+    assert is_dir_changed(tmp_path, states)  # nosec B101
+    assert not is_dir_changed(tmp_path, states, False)  # nosec B101
+
+    (tmp_path / "shelf" / "other.epub").write_bytes(b"data")
+    assert is_dir_changed(tmp_path, states, False)  # nosec B101
+
+
+def test_scan_dir_reuses_stats(tmp_path: Path) -> None:
+    (tmp_path / "shelf").mkdir()
+    (tmp_path / "shelf" / "book.epub").write_bytes(b"data")
+    library = scan_dir(tmp_path)
+    states = {tmp_path: library.get_state()}
+    states[tmp_path / "shelf"] = library.dirs[0].get_state()
+
+    (tmp_path / "shelf" / "book.epub").write_bytes(b"new data")
+    stats: dict[Path, FileStat] = {}
+    assert is_dir_changed(tmp_path, states, stats=stats)  # nosec B101
+    assert stats[tmp_path / "shelf" / "book.epub"].size == 8  # nosec B101
+
+    # Files checked for changes are not stat'ed again by the scan
+    stats[tmp_path / "shelf" / "book.epub"] = FileStat(1, 2, 3)
+    rescanned = scan_dir(tmp_path, states=states, stats=stats)
+    group = rescanned.dirs[0].file_groups[0]
+    assert group.stats[tmp_path / "shelf" / "book.epub"] == FileStat(1, 2, 3)  # nosec B101
@@ -1,6 +1,8 @@
+import io
 from pathlib import Path
 
 import pytest
+from PIL import Image
 
 from lib2opds.sidecars import (
     CoverSidecarFile,
@@ -14,3 +16,19 @@ from lib2opds.sidecars import (
 def test_metadata_sidecar_file() -> None:
     info = get_metadata_sidecar_file(Path("sidecar"))
     assert type(info) == InfoSidecarFile  # nosec B101
+
+
+@pytest.mark.parametrize(
+    "size,progressive,passthrough",
+    [((100, 50), False, True), ((100, 50), True, False), ((1000, 50), False, False)],
+)
+def test_cover_sidecar_file_passthrough(
+    size: tuple[int, int], progressive: bool, passthrough: bool
+) -> None:
+    data = io.BytesIO()
+    Image.new("RGB", size).save(data, "JPEG", progressive=progressive)
+
+    cover = get_cover_sidecar_file(Path("sidecar"), 500, 500, 70)
+    assert cover.read_bytes(data.getvalue())  # nosec B101
+    result = cover.to_bytes(70, 500, 500)
+    assert (result == data.getvalue()) == passthrough  # nosec B101
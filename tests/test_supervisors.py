@@ -0,0 +1,55 @@
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from lib2opds.formats import EbookFile
+from lib2opds.supervisors import ReadError, ReadSupervisor, read_ebook_file
+
+
+class TitleFile(EbookFile):
+    def read(self) -> bool:
+        self._metadata_file.title = self.fpath.stem
+        return True
+
+
+class SlowFile(EbookFile):
+    def read(self) -> bool:
+        time.sleep(60)
+        return True
+
+
+class BrokenFile(EbookFile):
+    def read(self) -> bool:
+        raise ValueError("broken")
+
+
+class CrashingFile(EbookFile):
+    def read(self) -> bool:
+        os._exit(1)
+
+
+def test_read_supervisor() -> None:
+    supervisor = ReadSupervisor(timeout=0.5)
+    try:
+        ebook_file = supervisor.read(TitleFile(Path("title.epub")))
+        assert ebook_file  # nosec B101
+        assert ebook_file.get_metadata().title == "title"  # nosec B101
+
+        with pytest.raises(ReadError, match="timed out"):
+            supervisor.read(SlowFile(Path("slow.pdf")))
+        with pytest.raises(ReadError, match="ValueError: broken"):
+            supervisor.read(BrokenFile(Path("broken.epub")))
+        with pytest.raises(ReadError, match="crashed"):
+            supervisor.read(CrashingFile(Path("crash.pdf")))
+
+        # The child process is started again after a crash
+        assert supervisor.read(TitleFile(Path("next.epub")))  # nosec B101
+    finally:
+        supervisor.close()
+
+
+def test_read_ebook_file_without_supervisor() -> None:
+    with pytest.raises(ReadError, match="ValueError: broken"):
+        read_ebook_file(BrokenFile(Path("broken.epub")))